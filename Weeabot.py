@@ -2,13 +2,11 @@ import random
 import traceback
 import asyncio
 import os
-import json
 import sys
 
 from collections import defaultdict
 from datetime import timedelta
 
-import pyimgur
 
 import discord
 from discord.ext import commands
@@ -16,6 +14,10 @@ from discord.ext.commands.bot import _get_variable
 
 import utils
 import checks
+import storage
+import httpclient
+import imgurclient
+import render
 from cogs.requestsystem import RequestLimit
 
 
@@ -30,6 +32,21 @@ class Weeabot(commands.Bot):
         self.config = utils.Config(os.path.join('config', 'config.json'), default={
             "prefix": "~",
             "ignored_cogs": [],
+            "flush_window": 5,
+            "tag_storage": "sqlite",
+            "download_concurrency": 8,
+            "http": {
+                "limit": 100,
+                "per_host": 10,
+                "timeout": 30,
+                "cache_size": 512,
+                "cache_dir": "status/httpcache",
+                "cache_dir_size": 4096
+            },
+            "render": {
+                "workers": 2,
+                "queue_size": 8
+            },
             "chatterbot": {
                 "import_path": "chatterbot.storage.MongoDatabaseAdapter",
                 "database_uri": "mongodb://localhost:27017/",
@@ -46,7 +63,16 @@ class Weeabot(commands.Bot):
         self.stats.update(utils.open_json(os.path.join('status', 'stats.json')))
         self.server_configs = utils.open_json(os.path.join('status', 'servers.json'))
         self.status = utils.open_json(os.path.join('status', 'status.json'))
-        self.imgur = pyimgur.Imgur(utils.tokens['imgur_token'], utils.tokens["imgur_secret"])
+        self.persistence = storage.Persistence(self.loop, self.config.flush_window)
+        self.persistence.register('stats', os.path.join('status', 'stats.json'), lambda: self.stats)
+        self.persistence.register('servers', os.path.join('status', 'servers.json'), lambda: self.server_configs)
+        self.persistence.register('status', os.path.join('status', 'status.json'), lambda: self.status)
+        self.usage = storage.UsageCounter()
+        self.blobs = storage.BlobStore(os.path.join('images', 'blobs'))
+        self.http_client = httpclient.HttpClient(self.loop, **self.config.http)
+        self.renderer = render.RenderService(self.loop, **self.config.render)
+        self._usage_task = None
+        self.imgur = imgurclient.AsyncImgur(self.loop, utils.tokens['imgur_token'], utils.tokens["imgur_secret"])
         self.services = {}
         self.formatters = {}
         self.verbose_formatters = {}
@@ -56,16 +82,21 @@ class Weeabot(commands.Bot):
         self.react_listeners = {}
 
     def dump_server_configs(self):
-        with open(os.path.join('status', 'servers.json'), 'w') as f:
-            json.dump(self.server_configs, f, ensure_ascii=True)
+        self.persistence.mark_dirty('servers')
 
     def dump_status(self):
-        with open(os.path.join('status', 'status.json'), 'w') as f:
-            json.dump(self.status, f, ensure_ascii=True)
+        self.persistence.mark_dirty('status')
 
     def dump_stats(self):
-        with open(os.path.join('status', 'stats.json'), 'w') as f:
-            json.dump(self.stats, f, ensure_ascii=True)
+        self.persistence.mark_dirty('stats')
+
+    async def close(self):
+        """Write any pending changes before closing."""
+        self.merge_usage()
+        await self.persistence.flush()
+        await self.http_client.close()
+        self.renderer.close()
+        await super(Weeabot, self).close()
     
     @property
     def profiles(self):
@@ -178,26 +209,81 @@ class Weeabot(commands.Bot):
         return reaction.reaction.emoji == '\N{THUMBS UP SIGN}'
 
     async def process_commands(self, message):
-        """Override process_commands to add _internal_message"""
+        """Override process_commands to add _internal_message and run tags before command lookup."""
         _internal_message = message
+        if await self.resolve_tag(message):
+            return
         await super(Weeabot, self).process_commands(message)
 
+    async def resolve_tag(self, message):
+        """Run a tag or tag id invoked like a command, `~cat` or `~42`, without a command lookup failing first.
+
+        Returns True if the message was handled."""
+        _internal_channel = message.channel
+        _internal_author = message.author
+
+        if self.tag_map is None or self._skip_check(message.author, self.user):
+            return False
+        prefix = await self._get_prefix(message)
+        prefixes = [prefix] if isinstance(prefix, str) else prefix
+        p = next((p for p in prefixes if message.content.startswith(p)), None)
+        if p is None:
+            return False
+        invoked = message.content[len(p):].split(maxsplit=1)
+        if not invoked or message.content[len(p)].isspace():
+            return False
+        name = invoked[0]
+        if name in self.commands:
+            return False
+
+        ctx = commands.Context(prefix=p, bot=self, message=message, invoked_with=name)
+        if name.isdigit():
+            try:
+                t = self.tag_map.get_by_id(int(name))
+            except IndexError:
+                await self.send_message(message.channel, "id not found.")
+                return True
+        else:
+            name = name.lower()
+            if name not in self.tag_map.taglist:
+                return False
+            t = self.tag_map.get(message, name)
+            if t is None:
+                return False
+        await t.run(ctx)
+        return True
+
     def inc_use(self, uid, fcn):
+        """Count a use of a command. Counts are batched and merged into the stats and profiles periodically."""
         if any([x in fcn for x in self.tracking_filter]):
             return
-        if fcn not in self.stats['command_use']:
-            self.stats['command_use'][fcn] = 0
-        self.stats['command_use'][fcn] += 1
-        if self.profiles is not None:
-            if uid not in self.profiles.all():
-                self.profiles.all()[uid] = {}
-            if 'command_count' not in self.profiles.all()[uid]:
-                self.profiles.all()[uid]['command_count'] = {}
-            if fcn not in self.profiles.all()[uid]['command_count']:
-                self.profiles.all()[uid]['command_count'][fcn] = 0
-            self.profiles.all()[uid]['command_count'][fcn] += 1
+        self.usage.inc(uid, fcn)
+        if self._usage_task is None or self._usage_task.done():
+            self._usage_task = self.loop.create_task(self._merge_usage_later())
+
+    async def _merge_usage_later(self):
+        await asyncio.sleep(self.config.flush_window)
+        self.merge_usage()
+
+    def merge_usage(self, uid=None):
+        """Merge batched command counts into the stores.
+
+        If a uid is passed, only that user's profile counts are merged. Used to show live totals."""
+        if uid is None:
+            total = self.usage.pop_total()
+            if total:
+                command_use = self.stats['command_use']
+                for fcn, n in total.items():
+                    command_use[fcn] = command_use.get(fcn, 0) + n
+                self.dump_stats()
+        users = self.usage.pop_users() if uid is None else {uid: self.usage.pop_user(uid)}
+        users = {u: c for u, c in users.items() if c}
+        if users and self.profiles is not None:
+            for u, counts in users.items():
+                command_count = self.profiles.all().setdefault(u, {}).setdefault('command_count', {})
+                for fcn, n in counts.items():
+                    command_count[fcn] = command_count.get(fcn, 0) + n
             self.profiles.dump()
-        self.dump_stats()
 
     def add_react_listener(self, msg, callback):
         """add a listener to perform an action when a reaction is done on a given message.
@@ -256,20 +342,8 @@ async def on_command_error(err, ctx):
         await bot.send_message(d, f"This command is on a {timestr(err.cooldown.per)} cooldown. Try again in {timestr(err.retry_after)}")
 
     elif type(err) is commands.CommandNotFound:
-        if ctx.invoked_with.isdigit():
-            if int(ctx.invoked_with) < len(bot.tag_map):
-                try:
-                    await bot.tag_map.get_by_id(int(ctx.invoked_with)).run(ctx)
-                except IndexError:
-                    await bot.send_message(ctx.message.channel, "id not found.")
-            else:
-                await bot.send_message(ctx.message.channel, "id not found.")
-        elif ctx.invoked_with.lower() in bot.tag_map.taglist:
-            t = ctx.invoked_with.split()[0]
-            try:
-                await bot.tag_map.get(ctx.message, t).run(ctx)
-            except KeyError:
-                pass
+        # tags and tag ids are resolved before command lookup, in Weeabot.resolve_tag.
+        pass
 
     else:
         print(f'Ignoring exception in command {ctx.command}', file=sys.stderr)
@@ -317,6 +391,25 @@ async def service_command():
     await bot.say('\n'.join([f'```\n{k}:\n\n{v}\n```' for k, v in bot.services.items()]))
 
 
+@bot.command(name='httpstats')
+@checks.is_owner()
+async def http_stats():
+    """Show http usage of each cog."""
+    lines = [f'{name:<16}{m["requests"]:>8}{m["errors"]:>8}{m["seconds"]:>10.1f}'
+             for name, m in sorted(bot.http_client.metrics.items())]
+    await bot.say('```\n{:<16}{:>8}{:>8}{:>10}\n{}\n```'.format('COG', 'REQ', 'ERR', 'SECONDS', '\n'.join(lines)))
+
+
+@bot.command(name='renderstats')
+@checks.is_owner()
+async def render_stats():
+    """Show time spent on each kind of render job."""
+    lines = [f'{name:<12}{m["jobs"]:>8}{m["errors"]:>8}{m["waiting"]:>10.1f}{m["seconds"]:>10.1f}'
+             for name, m in sorted(bot.renderer.metrics.items())]
+    await bot.say('```\n{:<12}{:>8}{:>8}{:>10}{:>10}\n{}\n```'.format('JOB', 'JOBS', 'ERR', 'WAITING', 'SECONDS',
+                                                                        '\n'.join(lines)))
+
+
 @bot.group(aliases=('e',), invoke_without_command=True)
 @checks.is_owner()
 async def extensions():
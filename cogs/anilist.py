@@ -48,18 +48,18 @@ class AniList(utils.SessionCog):
         for t in self.types:
             params = {"access_token": token, "year": year, "season": season, "type": t}
             url = "https://anilist.co/api/browse/anime"
-            async with self.session.get(url, params=params) as r:
-                js = await r.json()
-                if r.status != 200:
-                    await self.bot.edit_message(m, f"error in api call: response {r.status}\n{r.reason}\n{js['error_message']}")
-                    return
-                for anime in js:
-                    if not anime["adult"]:
-                        url = f"https://anilist.co/api/anime/{anime['id']}"
-                        async with self.session.get(url, params={"access_token": token}) as r2:
-                            anime = await r2.json()
-                            d = dateutil.parser.parse(anime["start_date"])
-                            days[d.weekday()].append(anime)
+            r = await self.session.cached(url, ttl=3600, params=params)
+            js = await r.json()
+            if r.status != 200:
+                await self.bot.edit_message(m, f"error in api call: response {r.status}\n{r.reason}\n{js['error_message']}")
+                return
+            for anime in js:
+                if not anime["adult"]:
+                    url = f"https://anilist.co/api/anime/{anime['id']}"
+                    r2 = await self.session.cached(url, ttl=3600, params={"access_token": token})
+                    anime = await r2.json()
+                    d = dateutil.parser.parse(anime["start_date"])
+                    days[d.weekday()].append(anime)
 
         anilist_url = f'http://anilist.co/browse/anime?sort=start_date-desc&year={year}&season={season}'
         e: discord.Embed = discord.Embed(
@@ -1,57 +1,143 @@
 import random
+import asyncio
 import json
 import pyimgur
 import traceback
 import datetime
 import re
 import math
+import time
+import hashlib
+import weakref
+import uuid
 
 from typing import Callable
 from typing import List
 
-from PIL import Image, ImageFont, ImageDraw, ImageSequence
 from os import path
 from os import listdir
 from os import makedirs
+from os import replace
+from os import remove
 from io import BytesIO
 from textwrap import shorten
+from urllib.parse import urlparse
 
 import discord
 from discord.ext import commands
 
 import utils
 import checks
+import render
 
 
 from cogs.tagsystem import TagItem
 from cogs.requestsystem import request
 
 
+class Booru:
+    """Client for a gelbooru style api.
+
+    Post counts go through the http cache, and posts are fetched a page at a time and handed out one by one,
+    so repeated requests for the same tags cost one round trip per page instead of two per image."""
+
+    page_size = 100
+    ttl = 600
+
+    def __init__(self, session, url: str):
+        self.session = session
+        self.url = url
+        # tags -> (expiry, shuffled posts not yet handed out)
+        self.pages = utils.LRU(64)
+        # tags -> lock, so requests for the same tags share a page. dropped when no request holds it.
+        self.locks = weakref.WeakValueDictionary()
+
+    async def count(self, tags: str) -> int:
+        params = {'page': 'dapi', 's': 'post', 'q': 'index', 'limit': 0, 'tags': tags}
+        r = await self.session.cached(self.url + '/index.php', ttl=self.ttl, params=params)
+        try:
+            return int(re.search(r'count="(\d+)"', await r.text()).group(1))
+        except AttributeError:
+            raise commands.BadArgument("API ERROR")
+
+    async def fetch_page(self, tags: str, count: int):
+        """Fetch a random page of posts. Returns a list of posts or an error message."""
+        pid = 0 if count <= self.page_size else random.randint(0, count // self.page_size - 1)
+        params = {'page': 'dapi', 's': 'post', 'q': 'index', 'json': 1, 'limit': self.page_size, 'pid': pid,
+                  'tags': tags}
+        async with self.session.get(self.url + '/index.php', params=params) as r:
+            if r.status != 200:
+                return f'Something went wrong. Error {r.status}'
+            try:
+                posts = json.loads(await r.text())
+            except json.JSONDecodeError:
+                return "API error"
+        random.shuffle(posts)
+        return posts
+
+    async def pick(self, tags: str, *filters: List[Callable[[dict], bool]], count: int=None):
+        """Get a random post with the tags that passes none of the filters. Returns an error message on failure."""
+        lock = self.locks.get(tags)
+        if lock is None:
+            lock = self.locks[tags] = asyncio.Lock()
+        async with lock:
+            count = await self.count(tags) if count is None else count
+            if count == 0:
+                return "No results"
+            # the page is shared by every caller with these tags, so only the post handed out is taken from it.
+            # if the filters reject the whole cached page, try one fresh page on top of it.
+            for attempt in range(2):
+                expires, posts = self.pages.get(tags, (0, []))
+                if not posts or expires < time.monotonic() or attempt:
+                    fresh = await self.fetch_page(tags, count)
+                    if isinstance(fresh, str):
+                        return fresh
+                    kept = posts if posts and expires >= time.monotonic() else []
+                    posts = (kept + fresh)[-2 * self.page_size:]
+                    self.pages[tags] = (time.monotonic() + self.ttl, posts)
+                for n in range(len(posts) - 1, -1, -1):
+                    if not any(f(posts[n]) for f in filters):
+                        return posts.pop(n)
+            return "No results"
+
+    def image_url(self, post: dict):
+        if 'file_url' in post:
+            if post['file_url'].startswith('http'):
+                return post['file_url']
+            return f'{self.url.split(":")[0]}:{post["file_url"]}'
+        return f'{self.url}/images/{post["directory"]}/{post["image"]}'
+
+    def post_url(self, post: dict):
+        return f'{self.url}/index.php?page=post&s=view&id={post["id"]}'
+
+
 class Images(utils.SessionCog):
     """Image related commands."""
 
+    collage_fetchers = 4
+    collage_width = 1000
+    collage_row_height = 333
+
     def __init__(self, bot):
         super(Images, self).__init__(bot)
         self.memes = bot.content.memes
+        self.boorus = {}
+        # rendered baka images by name
+        self.bakas = utils.LRU(256)
+        # avatar bytes by avatar url
+        self.avatars = utils.LRU(128)
     
     async def get_random_image(self, album_id):
         """Get a random image from an imgur album."""
-        image_list = (await self.bot.loop.run_in_executor(self.bot.imgur.get_album(album_id))).images
+        image_list = (await self.bot.imgur.get_album(album_id)).images
         return random.choice(image_list).link
 
     async def baka_image(self, ctx, t: str):
-        t = t[:7] + '...' if len(t) > 10 else t
-        i = 'you idiot...'
-        f = ImageFont.truetype(path.join("config", "ZinPenKeba-R.otf"), 12)
-        im = Image.open(path.join('images', 'collections', 'pout', 'baka.png'))
-        d = ImageDraw.Draw(im)
-        tw, th = d.textsize(t, f)
-        iw, ih = d.textsize(i, f)
-        d.text((250 - (tw // 2), 125 - (th // 2)), t, (0, 0, 0), font=f)
-        d.text((255 - (iw // 2), 150 - (ih // 2)), i, (0, 0, 0), font=f)
-        with BytesIO() as fp:
-            im.save(fp, 'PNG')
-            fp.seek(0)
+        if t not in self.bakas:
+            job = render.BakaJob(t, path.join('images', 'collections', 'pout', 'baka.png'),
+                                 path.join("config", "ZinPenKeba-R.otf"))
+            self.bakas[t] = (await self.bot.renderer.render(job)).data
+        with BytesIO(self.bakas[t]) as fp:
             await self.bot.send_file(ctx.message.channel, fp, filename='baka.png')
 
     @commands.command(pass_context=True, aliases=('b',))
@@ -96,18 +182,12 @@ class Images(utils.SessionCog):
         """Image commands.
 
         Get an image from a category or search through several online services with subcommands."""
-
-        def predicate(tag: TagItem):
-            if tag.image is None:
-                return False
-            if filetype is None:
-                return True
-            if tag.image.endswith(filetype):
-                return True
-            return False
-
+        view = 'image' if filetype is None else filetype.lstrip('.').lower()
+        if view in TagItem.text_views:
+            await self.bot.say("None found.")
+            return
         try:
-            t = self.bot.tag_map.get(ctx.message, category, predicate=predicate)
+            t = self.bot.tag_map.get(ctx.message, category, view=view)
         except KeyError:
             t = None
         if t is None:
@@ -136,15 +216,10 @@ class Images(utils.SessionCog):
                 return
         for link in links:
             if '//imgur.com/' in link:
-                link = self.bot.imgur.get_image(link.split('/')[-1]).link
-            name = "{}.{}".format(str(hash(link[-10:])), link.split('.')[-1])
-            if name in listdir(path.join(coldir, collection)):
-                await self.bot.notify("{} already existed, adding as temp. Correct soon so it isn't lost".format(name))
-                name = 'temp.png'
+                link = (await self.bot.imgur.get_image(link.split('/')[-1])).link
             try:
-                await utils.download(self.session, link, path.join(coldir, collection, name))
-                t = TagItem(ctx.message.author.id, str(ctx.message.timestamp), [collection],
-                            image=path.join(coldir, collection, name))
+                fn = await self.bot.blobs.download(self.session, link)
+                t = TagItem(ctx.message.author.id, str(ctx.message.timestamp), [collection], image=fn)
                 self.bot.tag_map[collection] = t
                 await t.run(ctx)
             except OSError:
@@ -162,26 +237,44 @@ class Images(utils.SessionCog):
         if len(collections) == 0:
             await self.bot.say("No tags given.")
             return
-        a = self.bot.imgur.get_at_url(link)
+        a = await self.bot.imgur.get_at_url(link)
         if not isinstance(a, pyimgur.Album):
             await self.bot.say('Not a valid imgur album.')
             return
 
         # initial response
         m = await self.bot.say(f'Getting {len(a.images)} images...')
-
-        # add all images
-        for im in a.images:
-            link = im.link
-            n = "{}.{}".format(str(hash(link[-10:])), link.split('.')[-1])
-            await utils.download(self.session, link, path.join('images', n))
-            i_path = path.join('images', n)
-
-            t = TagItem(ctx.message.author.id, str(ctx.message.timestamp), collections, image=i_path)
-            self.bot.tag_map[collections[0]] = t
-            for name in collections[1:]:
-                self.bot.tag_map.add_tag(t.id, name)
-        await self.bot.edit_message(m, f'Added {len(a.images)} images to {",".join(collections)}')
+        last_edit = 0
+        edit = None
+
+        def progress(done, total):
+            nonlocal last_edit, edit
+            # editing is rate limited, so only update every few seconds, with one edit pending at a time.
+            if time.monotonic() - last_edit > 3 and (edit is None or edit.done()):
+                last_edit = time.monotonic()
+                edit = self.bot.loop.create_task(self.bot.edit_message(m, f'Getting images... {done}/{total}'))
+
+        # download all images, then add them in one batch
+        pipeline = utils.DownloadPipeline(concurrency=self.bot.config.download_concurrency)
+        paths = await pipeline.run(lambda l: self.bot.blobs.download(self.session, l),
+                                   [im.link for im in a.images], progress)
+        failed = [p for p in paths if isinstance(p, Exception)]
+        if edit is not None:
+            # let it land before the final message, so it can't overwrite it.
+            try:
+                await edit
+            except discord.HTTPException:
+                pass
+        with self.bot.tag_map.batch():
+            for i_path in paths:
+                if isinstance(i_path, Exception):
+                    continue
+                t = TagItem(ctx.message.author.id, str(ctx.message.timestamp), [collections[0]], image=i_path)
+                self.bot.tag_map[collections[0]] = t
+                for name in collections[1:]:
+                    self.bot.tag_map.add_tag(t.id, name)
+        await self.bot.edit_message(m, f'Added {len(paths) - len(failed)} images to {",".join(collections)}' +
+                                    (f' ({len(failed)} failed)' if failed else ''))
 
     @image.command(name='list')
     async def _image_list(self):
@@ -190,54 +283,27 @@ class Images(utils.SessionCog):
         c_list = [x for x in listdir(path.join('images', 'collections')) if x not in r_list]
         await self.bot.say("List of categories: {}\nList of reactions: {}".format(", ".join(c_list), ", ".join(r_list)))
 
-    async def count_booru(self, url, tags):
-        params = {'page': 'dapi', 's': 'post', 'q': 'index', 'limit': 0, 'tags': tags}
-        async with self.session.get(url + '/index.php', params=params) as r:
-            try:
-                return int(re.search(r'count="(\d+)"', await r.text()).group(1))
-            except AttributeError:
-                raise commands.BadArgument("API ERROR")
-        
-    async def fetch_booru_image(self, url: str, tags: str, *filters: List[Callable[[dict], bool]], count=None):
-        count = count or await self.count_booru(url, tags)
-        params = {'page': 'dapi', 's': 'post', 'q': 'index', 'json': 1, 'pid': 0 if count <= 100 else random.randint(0, count // 100 - 1), 'tags': tags}
-        async with self.session.get(url + '/index.php', params=params) as r:
-            if r.status != 200:
-                return f'Something went wrong. Error {r.status}'
-            t = await r.text()
-            try:
-                ims = json.loads(t)
-            except json.JSONDecodeError:
-                return "API error"
-            filtered = [i for i in ims if not any(f(i) for f in filters)]
-
-            if len(filtered):
-                return random.choice(filtered)
-            else:
-                return "No results"
+    def booru(self, url: str) -> 'Booru':
+        if url not in self.boorus:
+            self.boorus[url] = Booru(self.session, url)
+        return self.boorus[url]
 
     async def post_booru_image(self, url: str, tags: str, *filters: List[Callable[[dict], bool]]):
         """post the returned image from a booru, or it's error message."""
         tmp = await self.bot.say("getting image from booru")
-        im = await self.fetch_booru_image(url, tags, *filters)
+        booru = self.booru(url)
+        count = await booru.count(tags)
+        im = await booru.pick(tags, *filters, count=count)
         if isinstance(im, dict):
-            count = await self.count_booru(url, tags)
-            if 'file_url' in im:
-                if im['file_url'].startswith('http'):
-                    img_url = im['file_url']
-                else:
-                    img_url = f'{url.split(":")[0]}:{im["file_url"]}'
-            else:
-                img_url = f'{url}/images/{im["directory"]}/{im["image"]}'
             e = discord.Embed(
                 title='This Image',
                 description=shorten(im['tags'].replace('_', r'\_').replace(' ', ', '), 2048, placeholder='...'),
-                url=f'{url}/index.php?page=post&s=view&id={im["id"]}'
+                url=booru.post_url(im)
             ).set_author(
                 name=f"{count} Images with these tags",
                 url=f"{url}/index.php?page=post&s=list&tags={'+'.join(tags.split())}"
             ).set_image(
-                url=img_url
+                url=booru.image_url(im)
             )
             try:
                 await self.bot.edit_message(tmp, '\N{ZERO WIDTH SPACE}', embed=e)
@@ -265,42 +331,73 @@ class Images(utils.SessionCog):
 
     async def post_booru_collage(self, url: str, tags: str, *filters: List[Callable[[dict], bool]]):
         """Make a collage from a booru."""
-        if await self.count_booru(url, tags) < 5:
+        booru = self.booru(url)
+        count = await booru.count(tags)
+        if count < 5:
             raise commands.BadArgument("Not enough images with those tags. Need at least 5 static images.")
 
         tmp = await self.bot.say(f"Collecting images")
+        queue = asyncio.Queue(maxsize=self.collage_fetchers)
+        errors = 0
+        last_edit = 0
+        edit = None
 
-        async def gen():
-            total_images = 0
-            errors = 0
-
-            while True:
-                im = await self.fetch_booru_image(url, tags, *filters)
-                if isinstance(im, str):
-                    return
-
-                if 'file_url' in im:
-                    img_url = f'{url.split(":")[0]}:{im["file_url"]}'
-                else:
-                    img_url = f'{url}/images/{im["directory"]}/{im["image"]}'
-                with await utils.download_fp(self.session, img_url) as fp:
+        async def fetch():
+            nonlocal errors
+            try:
+                while True:
+                    im = await booru.pick(tags, *filters, count=count)
+                    if isinstance(im, str):
+                        break
+                    img_url = booru.image_url(im)
                     try:
-                        v = fp
-                        iv = Image.open(v)
-                        yield iv
-                    except (OSError, ValueError) as e:
-                        if errors < 5:
-                            await self.bot.say("```py\n{}\n{}\n{}```".format(e, img_url, f'{url}/index.php?page=post&s=view&id={im["id"]}'))
-                            errors += 1
-                        else:
+                        with await utils.download_fp(self.session, img_url) as fp:
+                            data = fp.read()
+                        pi = await self.bot.renderer.render(render.DecodeJob(data, self.collage_row_height,
+                                                                             self.collage_width, None))
+                    except (OSError, ValueError, asyncio.TimeoutError) as e:
+                        errors += 1
+                        if errors > 5:
                             raise utils.CheckMsg("Too many erros. aborting.")
+                        await self.bot.send_message(tmp.channel, "```py\n{}\n{}\n{}```".format(e, img_url, booru.post_url(im)))
+                        continue
+                    await queue.put(pi)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # hand the error to the consumer to raise.
+                await queue.put(e)
+            else:
+                await queue.put(None)
 
+        async def gen():
+            nonlocal last_edit, edit
+            total_images = 0
+            finished = 0
+            while finished < self.collage_fetchers:
+                pi = await queue.get()
+                if pi is None:
+                    finished += 1
+                    continue
+                if isinstance(pi, Exception):
+                    raise pi
                 total_images += 1
-                await self.bot.edit_message(tmp, f"Collecting images {total_images}")
+                # editing is rate limited, so only update every few seconds.
+                if time.monotonic() - last_edit > 3:
+                    last_edit = time.monotonic()
+                    edit = self.bot.loop.create_task(self.bot.edit_message(tmp, f"Collecting images {total_images}"))
+                yield pi
 
-        with await self.make_collage(gen) as f:
-            await self.bot.delete_message(tmp)
-            await self.bot.upload(f, filename=f'{tags.replace(" ", "_")}_collage.png')
+        fetchers = [self.bot.loop.create_task(fetch()) for _ in range(self.collage_fetchers)]
+        try:
+            with await self.make_collage(gen) as f:
+                if edit is not None:
+                    edit.cancel()
+                await self.bot.delete_message(tmp)
+                await self.bot.upload(f, filename=f'{tags.replace(" ", "_")}_collage.png')
+        finally:
+            for t in fetchers:
+                t.cancel()
 
     @image.command()
     async def booru_collage(self, *, tags: str):
@@ -325,93 +422,50 @@ class Images(utils.SessionCog):
 
         Optional argument is a time window following reddit's time windows."""
         tmp = await self.bot.say("getting image from r/%s" % sub)
-        gal = self.bot.imgur.get_subreddit_gallery(sub, sort='top', window=window, limit=50)
+        gal = await self.bot.imgur.get_subreddit_gallery(sub, sort='top', window=window, limit=50)
         if len(gal) <= 1:
             await self.bot.edit_message(tmp, 'no images found at r/%s. did you spell it right?' % sub)
             return
         im = random.choice(gal)
-        if im is pyimgur.Album:
-            im = await self.bot.loop.run_in_executor(self.bot.imgur.get_image(self.get_random_image(im.id)))
+        if isinstance(im, pyimgur.Album):
+            im = await self.bot.imgur.get_image(random.choice((await self.bot.imgur.get_album(im.id)).images).id)
         if im.is_nsfw and not checks.tagged(ctx, 'lewd'):
             await self.bot.edit_message(tmp, "no ecchi.")
             return
         await self.bot.edit_message(tmp, "{0.title}\n{0.link}".format(im))
 
     async def make_collage(self, gen) -> BytesIO:
-        """Make a collage out of the images returned by the async generator."""
+        """Make a collage out of the images returned by the async generator.
+
+        The images should already be decoded to the row height, by a render.DecodeJob."""
         # approximate desired values
-        width = 1000
-        height = 1000
+        width = self.collage_width
         rows = 3
         line_width = 2
 
-        # calculate other values
-        row_height = height / rows
-        min_row_width = width * 2 / 3
-
         # create image jagged array. (row width, images)
         image_array = [[0, []]]
-        async for im in gen():
-            def process(pi):
-                # make new row if current is too large and we can make more rows
-                if image_array[-1][0] >= width:
-                    if len(image_array) == rows:
-                        return True
-                    image_array.append([0, []])
-
-                # load and perform initial resize on image.
-                pscale = row_height / pi.size[1]
-                pi = pi.resize([int(d * pscale) for d in pi.size], Image.ANTIALIAS)
-                pi.thumbnail((width, row_height))
-
-                # add to image array
-                image_array[-1][0] += pi.size[0] + (line_width if len(image_array[-1][1]) else 0)
-                image_array[-1][1].append(pi)
-            if await self.bot.loop.run_in_executor(None, process, im):
-                break
-
-        def fit_to_image():
-            # remove last row if below minimum.
-            if image_array[-1][0] < min_row_width:
-                del image_array[-1]
-
-            # fit each row to width
-            for i, (row_width, ims) in enumerate(image_array):
-                lines_amount = line_width * (len(ims) - 1)
-                if row_width != width:
-                    scale = width / (row_width - lines_amount)
-                    image_array[i][1] = [fi.resize([int(d * scale) for d in fi.size], Image.ANTIALIAS) for fi in ims]
-
-            # get the actual output height
-            out_height = sum(ims[1][0].size[1] for ims in image_array) + ((len(image_array) - 1) * line_width)
-
-            # create new Image object
-            image = Image.new('RGB', (width, int(out_height)))
-
-            # draw images on output image
-            y = 0
-            for _, ims in image_array:
-                x = 0
-                for i in ims:
-                    image.paste(i, (x, y))
-                    x += i.size[0] + line_width
-                y += ims[0].size[1] + line_width
-
-            fp = BytesIO()
-            image.save(fp, 'PNG')
-            fp.seek(0)
-            return fp
-        return await self.bot.loop.run_in_executor(None, fit_to_image)
+        async for pi in gen():
+            # make new row if current is too large and we can make more rows
+            if image_array[-1][0] >= width:
+                if len(image_array) == rows:
+                    break
+                image_array.append([0, []])
+
+            # add to image array
+            image_array[-1][0] += pi.size[0] + (line_width if len(image_array[-1][1]) else 0)
+            image_array[-1][1].append(pi)
+
+        job = render.CollageJob([ims for _, ims in image_array], width, width * 2 / 3, line_width)
+        return BytesIO((await self.bot.renderer.render(job)).data)
 
     @image.command(pass_context=True, name='collage', aliases=('c',))
     async def _image_collage(self, ctx, *names):
         """Generate a collage from images in a tag."""
-        types = ('.png', '.jpg', '.jpeg')
-
         async def gen():
             # get list of image
             try:
-                tags = self.bot.tag_map.get_items(*names, pred=lambda i: i.image and i.image.endswith(types))[:]
+                tags = self.bot.tag_map.get_items(*names, view='static')
                 random.shuffle(tags)
                 images = [i.image for i in tags]
             except KeyError:
@@ -421,9 +475,11 @@ class Images(utils.SessionCog):
                 raise commands.BadArgument("Not enough images in that tag. Need at least 5 static images.")
 
             for i in images:
-                yield Image.open(i)
+                thumbnail = self.bot.blobs.thumbnail(i, self.collage_row_height)
+                yield await self.bot.renderer.render(render.DecodeJob(i, self.collage_row_height, self.collage_width,
+                                                                      thumbnail))
 
-        # processing can take a while, so we type to acknowledge the command and run it in and executor.
+        # processing can take a while, so we type to acknowledge the command and render it in a worker process.
         await self.bot.type()
         with await self.make_collage(gen) as f:
             await self.bot.upload(f, filename=f'{"_".join(names)}_collage.png')
@@ -469,6 +525,33 @@ class Images(utils.SessionCog):
         await self.bot.content.save()
         await self.bot.say('Added {}'.format(name))
 
+    async def overlay_template(self, name: str, link: str) -> str:
+        """Get the local copy of an overlay template, downloading it the first time it is used.
+
+        Files are named by the template and its link, so a template whose link changed replaces its old file."""
+        directory = path.join('images', 'overlays')
+        prefix = hashlib.sha1(name.encode()).hexdigest()[:16] + '.'
+        ext = path.splitext(urlparse(link).path)[1]
+        fn = path.join(directory, prefix + hashlib.sha1(link.encode()).hexdigest() + ext)
+        if not path.exists(fn):
+            makedirs(directory, exist_ok=True)
+            # unique temporary name, as another overlay may be downloading the same template.
+            tmp = f'{fn}.{uuid.uuid4().hex}.tmp'
+            await utils.download(self.session, link, tmp)
+            replace(tmp, fn)
+            for old in listdir(directory):
+                if old.startswith(prefix) and not old.endswith('.tmp') and path.join(directory, old) != fn:
+                    remove(path.join(directory, old))
+        return fn
+
+    async def avatar(self, user: discord.User) -> tuple:
+        """Get a user's avatar as (key, bytes). The key is the avatar url, which changes with the avatar's hash."""
+        url = user.avatar_url or user.default_avatar_url
+        if url not in self.avatars:
+            with await utils.download_fp(self.session, url) as fp:
+                self.avatars[url] = fp.read()
+        return url, self.avatars[url]
+
     @image.group(pass_context=True, invoke_without_command=True)
     async def overlay(self, ctx, template: str, *users: discord.Member):
         """
@@ -497,77 +580,17 @@ class Images(utils.SessionCog):
         # fill remaining spots by duplicating the last user.
         images[-1] += ([images[-1][-1]] * (len(coords)-len(images[-1])))
 
-        # read template image
-        with await utils.download_fp(self.session, link) as fp:
-            original = Image.open(fp)
+        fn = await self.overlay_template(template, link)
 
-            # repeat once for each image to be generated
-            for i in images:
-                # copy image if there are more than one. If not use the original
-                im = original.copy() if len(images) > 1 else original
-
-                make_gif = any('.gif' in u.avatar_url for u in i)
-                frames = [im]
-
-                # paste each face
-                for index, c in enumerate(coords):
-                    # get user face for this coordinate
-                    u = i[index]
-                    with await utils.download_fp(self.session, u.avatar_url or u.default_avatar_url) as face_fp:
-                        face = Image.open(face_fp)
-
-                        # generate mask
-                        mask = Image.new("L", [c[2] * 4, c[2] * 4], color=0)
-                        ImageDraw.Draw(mask).ellipse((0, 0) + mask.size, fill=255)
-
-                        # paste the face
-                        if not make_gif:
-                            # resize face to requested size
-                            face.thumbnail((c[2], c[2]), Image.ANTIALIAS)
-                            mask = mask.resize(face.size, Image.ANTIALIAS)
-                            im.paste(
-                                face,
-                                (
-                                    c[0] - face.size[0]//2,
-                                    c[1] - face.size[1]//2
-                                ),
-                                mask
-                            )
-                        else:
-                            if face.format != 'GIF':
-                                face.thumbnail((c[2], c[2]), Image.ANTIALIAS)
-                                mask = mask.resize(face.size, Image.ANTIALIAS)
-                                for frame in frames:
-                                    frame.paste(
-                                        face,
-                                        (
-                                            c[0] - face.size[0] // 2,
-                                            c[1] - face.size[1] // 2
-                                        ),
-                                        mask
-                                    )
-                            else:
-                                for f_n, frame in enumerate(ImageSequence.Iterator(face)):
-                                    try:
-                                        f = frames[f_n]
-                                    except IndexError:
-                                        f = frames[-1].copy()
-                                        frames.append(f)
-                                    p = frame.copy()
-                                    p.thumbnail((c[2], c[2]), Image.ANTIALIAS)
-                                    m = mask.copy().resize(p.size, Image.ANTIALIAS)
-                                    f.paste(p, (c[0] - p.size[0] // 2, c[1] - p.size[1] // 2), m)
-
-                # send the image
-                out = BytesIO()
-                if make_gif:
-                    frames[0].save(out, 'GIF', save_all=True, append_images=frames[1:], loop=0)
-                    out.seek(0)
-                    await self.bot.upload(out, filename=f"{template}.gif")
-                else:
-                    im.save(out, 'PNG')
-                    out.seek(0)
-                    await self.bot.upload(out, filename=f"{template}.png")
+        # repeat once for each image to be generated
+        for i in images:
+            faces = [await self.avatar(u) for u in i]
+            job = render.OverlayJob(fn, faces, coords, any('.gif' in u.avatar_url for u in i))
+
+            # send the image
+            r = await self.bot.renderer.render(job)
+            with BytesIO(r.data) as out:
+                await self.bot.upload(out, filename=f"{template}.{r.ext}")
 
     @overlay.command(name='list')
     async def __overlay__list(self):
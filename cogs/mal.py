@@ -68,10 +68,10 @@ class MAL(utils.SessionCog):
             raise commands.BadArgument("{} has no saved MAL username.".format(user.display_name))
         mn = up['mal']
         params = {'u': mn, 'type': 'anime', 'status': 'all'}
-        async with self.session.get('https://myanimelist.net/malappinfo.php', params=params) as r:
-            if r.status != 200:
-                return
-            xml = xmltodict.parse(await r.text())
+        r = await self.session.cached('https://myanimelist.net/malappinfo.php', ttl=300, params=params)
+        if r.status != 200:
+            return
+        xml = xmltodict.parse(await r.text())
         if len(xml['myanimelist']) <= 1:
             raise commands.BadArgument("{} is not a valid MAL username.".format(mn))
         return xml['myanimelist']
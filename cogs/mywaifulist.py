@@ -34,8 +34,8 @@ class WaifuData(object):
 
     @staticmethod
     async def from_link(url, session, **data):
-        async with session.get(url) as r:
-            return WaifuData.from_html(await r.text(), **data)
+        r = await session.cached(url, ttl=600)
+        return WaifuData.from_html(await r.text(), **data)
 
     @staticmethod
     def from_html(html, **data):
@@ -137,8 +137,8 @@ class WaifuList(object):
 
     @staticmethod
     async def from_link(url, session, **data):
-        async with session.get(url) as r:
-            return WaifuList.from_html(await r.text(), **data)
+        r = await session.cached(url, ttl=600)
+        return WaifuList.from_html(await r.text(), **data)
 
     @staticmethod
     def from_html(html, **data):
@@ -183,8 +183,8 @@ class MyWaifuList(utils.SessionCog):
 
     async def search(self, term) -> list:
         """search for a term."""
-        async with self.session.get(f"{base_url}/search/{term}") as r:
-            return json.loads(await r.text())
+        r = await self.session.cached(f"{base_url}/search/{term}", ttl=3600)
+        return json.loads(await r.text())
 
     async def get_waifu(self, name) -> WaifuData:
         """get a waifu by name or slug."""
@@ -1,4 +1,3 @@
-import json
 import os
 
 import discord
@@ -95,10 +94,14 @@ class Polls:
         self.bot = bot
         raw_polls = utils.open_json(os.path.join('status', 'polls.json'))
         self.polls = {k: Poll(**raw_polls[k], bot=self.bot, poll_id=k) for k in raw_polls}
+        bot.persistence.register('polls', os.path.join('status', 'polls.json'),
+                                 lambda: {k: self.polls[k].dump() for k in self.polls})
+
+    def __unload(self):
+        self.bot.persistence.unregister('polls')
 
     def dump(self):
-        with open(os.path.join('status', 'polls.json'), 'w') as f:
-            json.dump({k: self.polls[k].dump() for k in self.polls}, f, ensure_ascii=True)
+        self.bot.persistence.mark_dirty('polls')
 
     async def update_polls(self, poll_server: str):
         """Update the polls message for a server."""
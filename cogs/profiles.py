@@ -8,6 +8,7 @@ import discord
 from discord.ext import commands
 
 import utils
+import storage
 
 from Weeabot import bot
 
@@ -62,6 +63,8 @@ class Profile(utils.SessionCog):
     formatters = {'command_count': count_formatter, 'custom': custom_formatter}
     verbose_formatters = {}
 
+    journal_limit = 1000  # journaled changes before the profiles are snapshotted
+
     def __init__(self, bot):
         super(Profile, self).__init__(bot)
         self.path = os.path.join('status', 'profiles.json')
@@ -74,15 +77,25 @@ class Profile(utils.SessionCog):
             for u in self._db:
                 if 'command_count' in self._db[u]:
                     self._db[u]['command_count'] = {k: v for k, v in self._db[u]['command_count'].items() if f not in k}
+        self.journal = storage.Journal(os.path.join('status', 'profiles.journal'))
+        for r in self.journal.replay():
+            stat = self._db.setdefault(r['u'], {}).setdefault('stat', stat_default())
+            stat['xp'] = stat.get('xp', 0) + r['xp']
+        bot.persistence.register('profiles', self.path, lambda: self._db,
+                                 before=self.journal.rotate, after=self.journal.discard_rotated)
         self.dump()
 
+    def __unload(self):
+        self.bot.persistence.unregister('profiles')
+        self.journal.close()
+
     def dump(self):
-        with open(self.path, 'w') as f:
-            json.dump(self._db, f, ensure_ascii=True)
+        """Mark the profiles as changed. They will be written in the next flush."""
+        self.bot.persistence.mark_dirty('profiles')
 
     async def save(self):
         """Save the current data to disk."""
-        await self.bot.loop.run_in_executor(None, self.dump)
+        self.dump()
 
     def get_by_id(self, uid: str):
         """Get the whole profile sructure of a user by their id. Generates if needed."""
@@ -125,7 +138,11 @@ class Profile(utils.SessionCog):
     async def on_message(self, message):
         """Event listener to record message length."""
         stat = self.get_field_by_id(message.author.id, 'stat')
-        stat['xp'] = stat.get('xp', 0) + len(message.clean_content)
+        xp = len(message.clean_content)
+        stat['xp'] = stat.get('xp', 0) + xp
+        self.journal.append({'u': message.author.id, 'xp': xp})
+        if self.journal.size >= self.journal_limit:
+            self.dump()
 
     @commands.group(invoke_without_command=True, pass_context=True, name='profile', aliases=('p',))
     async def prof(self, ctx, user: str=None):
@@ -141,6 +158,7 @@ class Profile(utils.SessionCog):
                 except commands.BadArgument as e:
                     await self.bot.say(e)
                     return
+            self.bot.merge_usage(usr.id)
             up = self.get_by_id(usr.id)
             e = discord.Embed(
                 color=usr.colour,
@@ -227,6 +245,7 @@ class Profile(utils.SessionCog):
             formatter = self.bot.formatters[cat]
         else:
             raise commands.BadArgument('{} not found.'.format(cat))
+        self.bot.merge_usage(usr.id)
         if cat not in self.get_by_id(usr.id):
             raise commands.BadArgument('{} not found for {}.'.format(cat, usr.display_name))
         try:
@@ -1,11 +1,20 @@
 import copy
+import json
 import pickle
+import sqlite3
+import base64
+import hashlib
+import asyncio
 import os
 
 import typing
 
 from enum import Enum
 from textwrap import shorten
+from collections import Counter
+from collections import OrderedDict
+from collections import defaultdict
+from collections import namedtuple
 
 import discord
 from discord.ext import commands
@@ -25,8 +34,8 @@ class PermissionInfo:
         self.checks = ch
         self.target = tar
 
-    def requests(self, ctx):
-        return ctx.bot.requestsystem.get_serv(self.target(ctx))
+    def has_request(self, ctx):
+        return ctx.bot.requestsystem.store.find(self.target(ctx), ctx.message) is not None
 
     def add_request(self, ctx):
         ctx.bot.loop.create_task(
@@ -115,7 +124,7 @@ def request(bypasses=list(), bypasser=any, delete_source=True):
                     return True
 
                 # check for elevation at this level
-                if wp and ctx.message in level.value.requests(ctx) or ctx.bypassed:
+                if wp and level.value.has_request(ctx) or ctx.bypassed:
                     # elevate to next position.
                     nc = req_checks[i - 1]
                     nlevel = PermissionLevel.from_check(nc)
@@ -149,7 +158,7 @@ def request_channel(bot, server: discord.Server):
 
 def parse_indexes(indexes: str = None):
     if not indexes:
-        return [0]
+        return []
     indexes = indexes.split()
     out = []
     try:
@@ -164,6 +173,230 @@ def parse_indexes(indexes: str = None):
     return out
 
 
+class RequestRecord(namedtuple('RequestRecord', 'message_id channel_id source_id author content timestamp '
+                                               'attachments mentions')):
+    """The parts of a request's message needed to show it and run it later.
+
+    `author` holds the fields of a discord user payload, `mentions` the ids of mentioned users."""
+
+    @classmethod
+    def from_message(cls, message: discord.Message):
+        return cls(
+            message.id,
+            message.channel.id,
+            message.server.id,
+            {
+                'id': message.author.id,
+                'username': message.author.name,
+                'discriminator': message.author.discriminator,
+                'avatar': message.author.avatar,
+                'bot': message.author.bot
+            },
+            message.content,
+            message.timestamp.isoformat(),
+            message.attachments,
+            [u.id for u in message.mentions]
+        )
+
+    def to_message(self, bot) -> discord.Message:
+        """Rebuild the message. Returns None if its channel is gone."""
+        channel = bot.get_channel(self.channel_id)
+        if channel is None:
+            return None
+        return discord.Message(
+            reactions=[],
+            id=self.message_id,
+            channel=channel,
+            author=self.author,
+            content=self.content,
+            timestamp=self.timestamp,
+            attachments=self.attachments,
+            mentions=[{'id': i} for i in self.mentions],
+            embeds=[]
+        )
+
+
+class RequestStore:
+    """Pending requests, indexed for constant time lookups and limit checks.
+
+    Each request gets an id that stays the same until it is accepted or rejected.
+    Requests are grouped by the server whose moderators handle them, or 'owner'."""
+
+    def __init__(self):
+        # id -> (server, record)
+        self.requests = {}
+        # server -> {message id: request id}, oldest first
+        self.servers = defaultdict(OrderedDict)
+        # pending requests by author id and by source server id
+        self.users = Counter()
+        self.sources = Counter()
+        # messages of requests, rebuilt from their records when needed
+        self.messages = {}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, rid: int):
+        return rid in self.requests
+
+    def __getitem__(self, rid: int):
+        return self.requests[rid]
+
+    def add(self, server: str, record: RequestRecord, rid: int) -> int:
+        """Add a request. Returns its id."""
+        self.requests[rid] = (server, record)
+        self.servers[server][record.message_id] = rid
+        self.users[record.author['id']] += 1
+        self.sources[record.source_id] += 1
+        return rid
+
+    def remove(self, rid: int):
+        """Remove a request. Returns its (server, record)."""
+        server, record = self.requests.pop(rid)
+        self.messages.pop(rid, None)
+        del self.servers[server][record.message_id]
+        if not self.servers[server]:
+            del self.servers[server]
+        for counter, key in ((self.users, record.author['id']), (self.sources, record.source_id)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        return server, record
+
+    def find(self, server: str, message: discord.Message):
+        """Get the id of a message's request in a server, or None."""
+        return self.servers.get(server, {}).get(message.id)
+
+    def ids(self, server: str) -> list:
+        """Ids of the requests in a server, oldest first."""
+        return list(self.servers.get(server, {}).values())
+
+
+class RequestDatabase:
+    """Keeps pending requests in sqlite, one row per request, so each change only writes that row.
+
+    The schema version is kept in sqlite's user_version, and `migrations` are applied in order to reach the latest."""
+
+    migrations = [
+        """
+        CREATE TABLE requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            channel_id TEXT NOT NULL,
+            source_id TEXT NOT NULL,
+            author TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            attachments TEXT NOT NULL,
+            mentions TEXT NOT NULL,
+            UNIQUE (server, message_id)
+        );
+        """
+    ]
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for v, migration in enumerate(self.migrations[version:], version + 1):
+            with self.db:
+                self.db.executescript(migration)
+                self.db.execute(f'PRAGMA user_version = {v}')
+
+    def migrate(self, pkl_path: str):
+        """Import requests pickled by older versions, then rename the pickle so it is not imported again.
+
+        Returns the imported (id, server, record)s."""
+        with open(pkl_path, 'rb') as f:
+            data = pickle.load(f)
+        if 'next_id' in data:
+            requests = data['requests'].items()
+        else:
+            # a list of messages for each server
+            requests = enumerate((s, m) for s in data for m in data[s])
+        rows = [(rid, server, RequestRecord.from_message(message)) for rid, (server, message) in requests]
+        with self.db:
+            for rid, server, record in rows:
+                self.insert(server, record, rid)
+        os.replace(pkl_path, f'{pkl_path}.migrated')
+        return rows
+
+    def load(self):
+        """Yield (id, server, record) for every request, oldest first."""
+        for rid, server, message_id, channel_id, source_id, author, content, timestamp, attachments, mentions in \
+                self.db.execute('SELECT * FROM requests ORDER BY id'):
+            yield rid, server, RequestRecord(message_id, channel_id, source_id, json.loads(author), content,
+                                             timestamp, json.loads(attachments), json.loads(mentions))
+
+    def insert(self, server: str, record: RequestRecord, rid: int=None) -> int:
+        """Add a request. Returns its id, which is never reused for another request."""
+        c = self.db.execute(
+            'INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (rid, server, record.message_id, record.channel_id, record.source_id, json.dumps(record.author),
+             record.content, record.timestamp, json.dumps(record.attachments), json.dumps(record.mentions))
+        )
+        self.db.commit()
+        return c.lastrowid
+
+    def delete(self, rids: [int]):
+        self.db.executemany('DELETE FROM requests WHERE id = ?', [(rid,) for rid in rids])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class Rehost:
+    """Rehosts images on imgur through the shared http client.
+
+    Images are hashed after downloading, so the same image attached twice is only uploaded once.
+    Links are remembered by source url and by hash, and saved with the bot's other stores."""
+
+    upload_url = 'https://api.imgur.com/3/image'
+    max_size = 20 * 1024 * 1024
+
+    def __init__(self, bot, path: str):
+        self.bot = bot
+        self.session = bot.http_client.session_for('Rehost')
+        data = utils.open_json(path)
+        # sha256 -> imgur link
+        self.links = data.get('links', {})
+        # source url -> sha256
+        self.urls = data.get('urls', {})
+        # uploads in progress by sha256
+        self.uploads = {}
+        bot.persistence.register('rehosts', path, lambda: {'links': self.links, 'urls': self.urls})
+
+    async def rehost(self, url: str) -> str:
+        """Get an imgur link with the same image as url."""
+        if self.urls.get(url) in self.links:
+            return self.links[self.urls[url]]
+        with await utils.download_fp(self.session, url, max_size=self.max_size) as fp:
+            data = fp.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.links:
+            if digest not in self.uploads:
+                self.uploads[digest] = self.bot.loop.create_task(self.upload(data))
+            try:
+                self.links[digest] = await asyncio.shield(self.uploads[digest])
+            finally:
+                self.uploads.pop(digest, None)
+        self.urls[url] = digest
+        self.bot.persistence.mark_dirty('rehosts')
+        return self.links[digest]
+
+    async def upload(self, data: bytes) -> str:
+        headers = {'Authorization': f"Client-ID {utils.tokens['imgur_token']}"}
+        payload = {'image': base64.b64encode(data).decode(), 'type': 'base64'}
+        async with self.session.post(self.upload_url, data=payload, headers=headers) as r:
+            js = await r.json()
+            if r.status != 200 or not js.get('success'):
+                raise commands.CommandError(f"Could not rehost image: {r.status} {js.get('data', {}).get('error')}")
+            return js['data']['link']
+
+
 class RequestSystem:
     """Request system."""
 
@@ -173,38 +406,23 @@ class RequestSystem:
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.path = os.path.join('status', 'requests.pkl')
-        try:
-            with open(self.path, 'rb') as f:
-                self.requests = pickle.load(f)
-            if len(self.requests) == 0:
-                self.requests = {"owner": []}
-        except FileNotFoundError:
-            self.requests = {"owner": []}
-        self._dump()
-
-    def _dump(self):
-        with open(self.path, 'wb') as f:
-            pickle.dump(self.requests, f, -1)
-
-    async def save(self):
-        """Save the current data to disk."""
-        await self.bot.loop.run_in_executor(None, self._dump)
-
-    def all_req(self):
-        r = []
-        for serv in self.requests:
-            for m in self.requests[serv]:
-                r.append(m)
-        return r
-
-    def get_serv(self, server):
-        if server not in self.requests:
-            self.requests[server] = []
-        return self.requests[server]
-
-    def remove_from_serv(self, server, rs):
-        self.requests[server] = [r for r in self.requests[server] if r not in rs]
+        self.db = RequestDatabase(os.path.join('status', 'requests.db'))
+        self.store = RequestStore()
+        pkl_path = os.path.join('status', 'requests.pkl')
+        rows = self.db.migrate(pkl_path) if os.path.exists(pkl_path) else self.db.load()
+        for rid, server, record in rows:
+            self.store.add(server, record, rid)
+        self.rehost = Rehost(bot, os.path.join('status', 'rehosts.json'))
+
+    def __unload(self):
+        self.bot.persistence.unregister('rehosts')
+        self.db.close()
+
+    def message(self, rid: int):
+        """Get the message of a request, rebuilding it if needed. None if it can't be rebuilt."""
+        if rid not in self.store.messages:
+            self.store.messages[rid] = self.store[rid][1].to_message(self.bot)
+        return self.store.messages[rid]
 
     @commands.command(pass_context=True, no_pm=True)
     @checks.is_server_owner()
@@ -240,20 +458,14 @@ class RequestSystem:
         self.bot.server_configs.get(ctx.message.server.id, {})['request_channel'] = None
         self.bot.dump_server_configs()
 
-    def get_ind(self, server, mes):
-        """get the index of a message in a server."""
-        try:
-            return self.get_serv(server).index(mes)
-        except ValueError:
-            return None
-
-    async def send_req_msg(self, server, msg: discord.Message, ind, *, dest=None, new=False):
+    async def send_req_msg(self, server, msg: discord.Message, rid: int, *, dest=None, new=False):
         dest = dest or request_channel(self.bot, self.bot.get_server(server)) or self.bot.owner
 
         e = discord.Embed(
-            title="Index: {}".format(ind),
+            title="Id: {}".format(rid),
             description=msg.content,
-            colour=msg.author.colour,
+            # rebuilt messages from authors that left the server have a User, which has no colour.
+            colour=getattr(msg.author, 'colour', discord.Embed.Empty),
             timestamp=msg.timestamp
         )
         url = discord.Embed.Empty
@@ -278,10 +490,10 @@ class RequestSystem:
         async def callback(reaction, user):
             if user == self.bot.owner or self.bot.user_is_moderator(user):
                 if reaction.emoji == pos:
-                    await self.accept_requests(user, server, self.get_ind(server, msg))
+                    await self.accept_requests(user, server, rid)
                     return
                 elif reaction.emoji == neg:
-                    await self.reject_requests(server, [self.get_ind(server, msg)])
+                    await self.reject_requests(server, [rid])
                     return
             self.bot.add_react_listener(ret, callback)
         await self.bot.add_reaction(ret, pos)
@@ -291,30 +503,32 @@ class RequestSystem:
         return ret
 
     async def add_request(self, mes: discord.Message, server, delete_source):
-        if mes in self.get_serv(server):
+        if self.store.find(server, mes) is not None:
             # if the message is already in the specified server's list, no reason to re-add it
             return
 
-        if len(list(filter(lambda e: e.author.id == mes.author.id, self.all_req()))) >= self.user_limit:
+        if self.store.users[mes.author.id] >= self.user_limit:
             raise RequestLimit("{}, user request limit reached ({}).".format(mes.author.display_name, self.user_limit))
-        if len(list(filter(lambda e: e.server.id == mes.server.id, self.all_req()))) >= self.server_limit:
+        if self.store.sources[mes.server.id] >= self.server_limit:
             raise RequestLimit("{}, server request limit reached ({}).".format(mes.server.name, self.server_limit))
-        if len(self.all_req()) >= self.global_limit:
+        if len(self.store) >= self.global_limit:
             raise RequestLimit("Global request limit reached ({}).".format(self.global_limit))
 
         # rehost images on imgur, since we will be deleting the original image
         if len(mes.attachments) == 1:
-            url = mes.attachments[0]['url']
-            im = self.bot.imgur.upload_image(url=url)
-            mes.attachments[0]['url'] = im.link
+            mes.attachments[0]['url'] = await self.rehost.rehost(mes.attachments[0]['url'])
+        if self.store.find(server, mes) is not None:
+            # added by another invocation while rehosting
+            return
 
         # add the request to the specified server's list
-        ind = len(self.get_serv(server))
-        await self.send_req_msg(server, mes, ind, new=True)
+        record = RequestRecord.from_message(mes)
+        rid = self.store.add(server, record, self.db.insert(server, record))
+        self.store.messages[rid] = mes
+
+        await self.send_req_msg(server, mes, rid, new=True)
         if server != 'owner' or mes.server.owner.id == mes.author.id:
-            await self.send_req_msg(server, mes, ind, dest=mes.channel, new=True)
-        self.get_serv(server).append(mes)
-        await self.save()
+            await self.send_req_msg(server, mes, rid, dest=mes.channel, new=True)
         if delete_source:
             try:
                 await self.bot.delete_message(mes)
@@ -330,12 +544,14 @@ class RequestSystem:
     async def list(self, ctx):
         """Display current requests."""
         server = 'owner' if ctx.message.channel.is_private else ctx.message.server.id
-        reqs = self.get_serv(server)
-        if len(reqs) == 0:
+        ids = self.store.ids(server)
+        if len(ids) == 0:
             await self.bot.say("None.")
             return
-        for ind, r in enumerate(reqs):
-            await self.send_req_msg(server, r, ind, dest=ctx.message.channel)
+        for rid in ids:
+            msg = self.message(rid)
+            if msg is not None:
+                await self.send_req_msg(server, msg, rid, dest=ctx.message.channel)
 
     async def send_req_status(self, rs, stat):
         # sort messages by channel and author
@@ -350,78 +566,81 @@ class RequestSystem:
                 icon_url=s.author.avatar_url or s.author.default_avatar_url
             ))
 
-    async def accept_requests(self, approver, server, *indexes):
-        if indexes is None:
-            return
+    async def find_requests(self, server, ids: [int]) -> [int]:
+        """Get the ids that belong to requests in a server, telling about any that don't.
 
-        _internal_approver = approver
+        Takes the oldest request if no ids are passed."""
+        ids = list(OrderedDict.fromkeys(ids or self.store.ids(server)[:1]))
+        missing = [i for i in ids if i not in self.store or self.store[i][0] != server]
+        if missing:
+            await self.bot.say(shorten(f'Not found: {missing}', 2000, placeholder='...'))
+        return [i for i in ids if i not in missing]
 
-        rs = self.get_serv(server)
+    def remove_requests(self, ids: [int]):
+        # another approver may have gotten to some first.
+        ids = [i for i in ids if i in self.store]
+        for i in ids:
+            self.store.remove(i)
+        self.db.delete(ids)
 
-        oor = [i for i in indexes if not 0 <= i < len(rs)]
-        if oor:
-            await self.bot.say(shorten(f'Out of range: {oor}', 2000, placeholder='...'))
+    async def accept_requests(self, approver, server, *ids):
+        _internal_approver = approver
 
-        rs = [rs[i] for i in indexes if i not in oor]
+        ids = await self.find_requests(server, ids)
+        # requests whose channel was deleted can't be run, and are dropped.
+        rs = [m for m in map(self.message, ids) if m is not None]
 
         await self.send_req_status(rs, f'approved by {_internal_approver.display_name}')
 
+        # requests stay in the store while processing, so the request checks can see whether they are elevated.
         for r in rs:
             await self.bot.process_commands(r)
-        self.remove_from_serv(server, rs)
-        await self.save()
+        self.remove_requests(ids)
 
     @req.command(pass_context=True, aliases=('a', 'approve'))
     @commands.check(lambda ctx: checks.owner(ctx) or checks.moderator(ctx))
-    async def accept(self, ctx, *, indexes: str="0"):
+    async def accept(self, ctx, *, ids: str=None):
         """Accept requests made by users.
 
-        Request 0 is chosen if no index is passed.
-
-        Separate indexes by spaces. To express a range of indexes, put a dash between them.
-        \"0 3-6 8\" for example would be the indexes 0, 3, 4, 5, 6, and 8.
+        The oldest request is chosen if no id is passed.
 
-        Be aware that after this command, indexes on unaffected requests will be changed."""
-        indexes = parse_indexes(indexes)
+        Separate ids by spaces. To express a range of ids, put a dash between them.
+        \"0 3-6 8\" for example would be the ids 0, 3, 4, 5, 6, and 8."""
+        ids = parse_indexes(ids)
 
         server = 'owner' if ctx.message.channel.is_private else ctx.message.server.id
 
-        await self.accept_requests(ctx.message.author, server, *indexes)
+        await self.accept_requests(ctx.message.author, server, *ids)
 
-    async def reject_requests(self, server, indexes: [int]):
-        rs = self.get_serv(server)
-        oor = [i for i in indexes if not 0 <= i < len(rs)]
-        if oor:
-            await self.bot.say(shorten(f'Out of range: {oor}', 2000, placeholder='...'))
-
-        rs = [rs[i] for i in indexes if i not in oor]
+    async def reject_requests(self, server, ids: [int]):
+        ids = await self.find_requests(server, ids)
+        rs = [m for m in map(self.message, ids) if m is not None]
 
         await self.send_req_status(rs, 'denied')
 
-        self.remove_from_serv(server, rs)
-        await self.save()
+        self.remove_requests(ids)
 
     @req.command(pass_context=True, aliases=('r', 'deny', 'd'))
     @commands.check(lambda ctx: checks.owner(ctx) or checks.moderator(ctx))
-    async def reject(self, ctx, *, indexes: str=None):
+    async def reject(self, ctx, *, ids: str=None):
         """Reject requests made by users.
 
-        Request 0 is chosen if no index is passed.
-
-        Separate indexes by spaces. To express a range of indexes, put a dash between them.
-        \"0 3-6 8\" for example would be the indexes 0, 3, 4, 5, 6, and 8.
+        The oldest request is chosen if no id is passed.
 
-        Be aware that after this command, indexes on unaffected requests will be changed."""
+        Separate ids by spaces. To express a range of ids, put a dash between them.
+        \"0 3-6 8\" for example would be the ids 0, 3, 4, 5, 6, and 8."""
         server = 'owner' if ctx.message.channel.is_private else ctx.message.server.id
-        indexes = parse_indexes(indexes)
-        await self.reject_requests(server, indexes)
+        ids = parse_indexes(ids)
+        await self.reject_requests(server, ids)
 
     @req.command(pass_context=True, aliases=('c',))
     @checks.is_server_owner()
     async def clear(self, ctx):
         """Clear remaining requests."""
         server = 'owner' if ctx.message.channel.is_private else ctx.message.server.id
-        await self.reject_requests(server, list(range(len(self.get_serv(server)))))
+        ids = self.store.ids(server)
+        if ids:
+            await self.reject_requests(server, ids)
 
 
 def setup(bot):
@@ -1,9 +1,12 @@
 import os
 import json
 import random
-import aiohttp
 import re
 import copy
+import contextlib
+import sqlite3
+import heapq
+import traceback
 from collections import defaultdict
 
 import discord
@@ -112,6 +115,10 @@ class TagItem:
     def image(self):
         return self.image_path and os.path.join(*self.image_path)
 
+    @image.setter
+    def image(self, image: str):
+        self.image_path = image and re.split(r'\\|/', image)
+
     def as_json(self):
         """json safe value."""
         return {
@@ -125,6 +132,28 @@ class TagItem:
             "method": self.method
         }
 
+    static_types = ('png', 'jpg', 'jpeg')
+    # views of items without an image. every other view only holds images.
+    text_views = ('text', 'embed', 'alias')
+
+    def views(self):
+        """The names of the precomputed views this item belongs to.
+
+        Media kinds (image, static, gif, text, embed, alias) and the lowercase file extension of the image."""
+        if self.method == 'embed':
+            return {'embed'}
+        if self.method == 'alias':
+            return {'alias'}
+        if self.image is None:
+            return {'text'}
+        ext = os.path.splitext(self.image)[1][1:].lower()
+        v = {'image', ext} if ext else {'image'}
+        if ext in self.static_types:
+            v.add('static')
+        elif ext == 'gif':
+            v.add('gif')
+        return v
+
     def detail(self, ctx):
         if ctx.message.channel.is_private:
             name = discord.utils.get(ctx.bot.get_all_members(), id=self.author).name
@@ -144,20 +173,318 @@ class TagItem:
         await self.methods[self.method](self, ctx)
 
 
+def alias_table(weights):
+    """Build a table for Vose's alias method, allowing O(1) weighted picks."""
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights]
+    prob = [0.0] * n
+    alias = [0] * n
+    small = [i for i, w in enumerate(scaled) if w < 1]
+    large = [i for i, w in enumerate(scaled) if w >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+class Selector:
+    """Picks items from a tag (or a view of one) according to a selection mode.
+
+    Modes:
+        random: every item is equally likely.
+        shuffle: shuffle-bag. no item repeats until every item has been picked.
+        recent: newer items are more likely.
+        usage: items that have been picked less are more likely.
+
+    Weighted modes use a precomputed alias table, so picks are O(1). Tables are rebuilt when the items change,
+    and in usage mode also after every len(items) picks so the weights follow the usage."""
+
+    modes = ('random', 'shuffle', 'recent', 'usage')
+
+    def __init__(self, mode: str, uses, items):
+        self.mode = mode
+        self.uses = uses
+        self.items = items
+        self.ids = None
+        self.version = None
+        self.order = []
+        self.table = None
+        self.bag = []
+        self.seen = set()
+        self.picks = 0
+
+    def _rebuild(self, ids):
+        self.ids = ids
+        self.version = ids.version
+        self.picks = 0
+        if self.mode == 'shuffle':
+            self.bag = [i for i in ids if i not in self.seen]
+            random.shuffle(self.bag)
+        else:
+            self.order = list(ids)
+            if self.mode == 'recent':
+                # ids are reused, so they don't follow age. rank by when the item was added.
+                ranks = {i: r for r, i in enumerate(sorted(self.order, key=self.added), 1)}
+                self.table = alias_table([ranks[i] for i in self.order])
+            else:
+                self.table = alias_table([1 / (1 + self.uses[i]) for i in self.order])
+
+    def forget(self, i):
+        """Drop the state kept about an id, when its item is deleted."""
+        self.seen.discard(i)
+
+    def added(self, i):
+        # str(datetime), which sorts chronologically. items without one sort as oldest.
+        return self.items[i].timestamp or '', i
+
+    def pick(self, ids):
+        """Pick an id from ids, a utils.IndexedSet."""
+        if self.mode not in self.modes or self.mode == 'random':
+            return random.choice(ids)
+        if self.ids is not ids or self.version != ids.version or (self.mode == 'usage' and self.picks >= len(self.order)):
+            self._rebuild(ids)
+        if self.mode == 'shuffle':
+            if not self.bag:
+                self.seen.clear()
+                self._rebuild(ids)
+            i = self.bag.pop()
+            self.seen.add(i)
+            return i
+        # usage weights are rebuilt after every len(items) picks.
+        self.picks += 1
+        prob, alias = self.table
+        col = random.randrange(len(prob))
+        return self.order[col] if random.random() < prob[col] else self.order[alias[col]]
+
+
+class JsonTagStorage:
+    """Keeps the whole tag database in a single json file.
+
+    Any change marks the file dirty, and it is rewritten in the next persistence flush."""
+
+    def __init__(self, bot: commands.Bot, path: str, data):
+        self.bot = bot
+        self.path = path
+        bot.persistence.register('tags', path, data)
+
+    def load(self):
+        """Return the tag lists and the json values of every item."""
+        json_data = utils.open_json(self.path) or {"tags": {}, "items": []}
+        return json_data["tags"], json_data["items"]
+
+    def dump(self):
+        self.bot.persistence.mark_dirty('tags')
+
+    def save_item(self, item: TagItem):
+        self.dump()
+
+    def delete_item(self, item_id: int):
+        self.dump()
+
+    def add_link(self, name: str, item_id: int):
+        self.dump()
+
+    def remove_link(self, name: str, item_id: int):
+        self.dump()
+
+    def compact(self):
+        self.dump()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # changes are already coalesced by the persistence flush window.
+        yield
+
+    def close(self):
+        self.bot.persistence.unregister('tags')
+
+
+class SqliteTagStorage:
+    """Keeps the tag database in sqlite, so each change only touches the affected rows.
+
+    Items, tags and the links between them are stored in separate tables.
+    If the database is empty and a json database exists, it is imported once and renamed."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY,
+            author TEXT,
+            timestamp TEXT,
+            tags TEXT NOT NULL,
+            text TEXT,
+            image TEXT,
+            location TEXT,
+            method TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS tag_items (
+            tag_id INTEGER NOT NULL REFERENCES tags(id),
+            item_id INTEGER NOT NULL REFERENCES items(id),
+            UNIQUE (tag_id, item_id)
+        );
+        CREATE INDEX IF NOT EXISTS tag_items_item ON tag_items(item_id);
+    """
+
+    def __init__(self, path: str, json_path: str=None):
+        self.path = path
+        self._batch = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.schema)
+        if json_path is not None and os.path.exists(json_path) and not self.db.execute(
+                'SELECT 1 FROM items LIMIT 1').fetchone():
+            self.migrate(json_path)
+
+    def migrate(self, json_path: str):
+        """Import a json tag database, then rename the json file so it is not imported again."""
+        json_data = utils.open_json(json_path) or {"tags": {}, "items": []}
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._item_row(TagItem(**v)) for v in json_data["items"] if v is not None]
+            )
+            for name, ids in json_data["tags"].items():
+                tag_id = self._tag_id(name)
+                self.db.executemany('INSERT OR IGNORE INTO tag_items VALUES (?, ?)', [(tag_id, i) for i in ids])
+        os.replace(json_path, f'{json_path}.migrated')
+
+    @staticmethod
+    def _item_row(item: TagItem):
+        return (item.id, item.author, item.timestamp, json.dumps(item.tags), item.text,
+                None if item.image_path is None else json.dumps(item.image_path), item.location, item.method)
+
+    def _tag_id(self, name: str):
+        self.db.execute('INSERT OR IGNORE INTO tags (name) VALUES (?)', (name,))
+        return self.db.execute('SELECT id FROM tags WHERE name = ?', (name,)).fetchone()[0]
+
+    def load(self):
+        """Return the tag lists and the json values of every item."""
+        items = []
+        for item_id, author, timestamp, tags, text, image, location, method in self.db.execute(
+                'SELECT * FROM items ORDER BY id'):
+            items += [None] * (item_id - len(items))
+            items.append({
+                "item_id": item_id,
+                "author": author,
+                "timestamp": timestamp,
+                "tags": json.loads(tags),
+                "text": text,
+                "image": None if image is None else json.loads(image),
+                "location": location,
+                "method": method
+            })
+        tags = defaultdict(list)
+        for name, item_id in self.db.execute(
+                'SELECT tags.name, tag_items.item_id FROM tag_items JOIN tags ON tags.id = tag_items.tag_id '
+                'ORDER BY tag_items.rowid'):
+            tags[name].append(item_id)
+        return tags, items
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group changes into a single transaction."""
+        self._batch += 1
+        try:
+            yield
+        finally:
+            self._batch -= 1
+            self._commit()
+
+    def _commit(self):
+        if not self._batch:
+            self.db.commit()
+
+    def save_item(self, item: TagItem):
+        self.db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._item_row(item))
+        self._commit()
+
+    def _drop_unused_tags(self, tag_ids):
+        # only the given tags are checked, rather than sweeping the whole table.
+        self.db.executemany(
+            'DELETE FROM tags WHERE id = ? AND NOT EXISTS (SELECT 1 FROM tag_items WHERE tag_id = tags.id)',
+            [(t,) for t in tag_ids]
+        )
+
+    def delete_item(self, item_id: int):
+        tag_ids = [r[0] for r in self.db.execute('SELECT tag_id FROM tag_items WHERE item_id = ?', (item_id,))]
+        self.db.execute('DELETE FROM tag_items WHERE item_id = ?', (item_id,))
+        self.db.execute('DELETE FROM items WHERE id = ?', (item_id,))
+        self._drop_unused_tags(tag_ids)
+        self._commit()
+
+    def add_link(self, name: str, item_id: int):
+        self.db.execute('INSERT OR IGNORE INTO tag_items VALUES (?, ?)', (self._tag_id(name), item_id))
+        self._commit()
+
+    def remove_link(self, name: str, item_id: int):
+        row = self.db.execute('SELECT id FROM tags WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return
+        self.db.execute('DELETE FROM tag_items WHERE item_id = ? AND tag_id = ?', (item_id, row[0]))
+        self._drop_unused_tags([row[0]])
+        self._commit()
+
+    def compact(self):
+        self.db.execute('VACUUM')
+
+    def close(self):
+        self.db.close()
+
+
 class TagMap:
     """Data structure similar to a map, but items can have multiple keys.
     Unlike a map, the structure is intended for getting 'an item, any item' matching a description.
     Since it is sometimes necessary to remove or edit items, they can still be accessed by unique indexes."""
 
     def __init__(self, bot: commands.Bot, json_path: str=None):
-        """Construct a TagMap from a json file specified by path."""
+        """Construct a TagMap from the storage backend chosen in the config."""
         self.bot = bot
+        self.session = bot.http_client.session_for('TagMap')
         self.path = json_path or os.path.join('status', 'tag_database.json')
-        json_data = utils.open_json(self.path) or {"tags": {}, "items": []}
-        self._tags = defaultdict(list)
-        self._tags.update(json_data["tags"])
-        self._items = [None if v is None else TagItem(**v) for v in json_data["items"]]
-        self.dump()
+        if bot.config.tag_storage == 'json':
+            self.storage = JsonTagStorage(bot, self.path, self.as_json)
+        else:
+            self.storage = SqliteTagStorage(os.path.join('status', 'tag_database.db'), self.path)
+        tags, items = self.storage.load()
+        self._items = [None if v is None else TagItem(**v) for v in items]
+        self._adopt_images()
+        # tag name -> ids, and the reverse index of id -> tag names.
+        self._tags = {}
+        self._item_tags = defaultdict(set)
+        # (tag name, view name) -> ids, and the views each item was indexed under.
+        self._views = {}
+        self._item_views = {}
+        # (tag name, view name, mode) -> Selector, and how many times each item has been picked.
+        self._selectors = {}
+        self._uses = defaultdict(int)
+        # older databases can have tags still listing deleted items. drop those links instead of loading them.
+        stale = []
+        for name, ids in tags.items():
+            for i in ids:
+                if 0 <= i < len(self._items) and self._items[i] is not None:
+                    self._link(name, i)
+                else:
+                    stale.append((name, i))
+        if stale:
+            with self.storage.batch():
+                for name, i in stale:
+                    self.storage.remove_link(name, i)
+        for i in self._items:
+            if i is not None:
+                bot.blobs.ref(i.image)
+        # free ids, smallest first.
+        self._free = [i for i, x in enumerate(self._items) if x is None]
+        heapq.heapify(self._free)
 
         self.services = {
             "Tags": f"""Custom content can be added to the bot through the tag system.
@@ -165,37 +492,86 @@ class TagMap:
             Use {self.bot.command_prefix}help tag for more info."""
         }
 
-    def dump(self):
-        """Save the TagMap to the path given originally as a json file."""
-        with open(self.path, 'w') as f:
-            json.dump({"tags": dict(self._tags),
-                       "items": [None if i is None else i.as_json() for i in self._items]}, f, ensure_ascii=True)
+    # images that commands also open by path. tag items using them are left outside the blob store.
+    kept_images = (os.path.join('images', 'collections', 'pout', 'baka.png'),)
+
+    def _adopt_images(self):
+        # images from before the blob store are moved into it once, which merges the duplicates among them.
+        moved = {}
+        with self.storage.batch():
+            for item in self._items:
+                if item is None or item.image is None or self.bot.blobs.is_blob(item.image):
+                    continue
+                if os.path.normpath(item.image) in self.kept_images:
+                    continue
+                if item.image not in moved:
+                    if not os.path.isfile(item.image):
+                        continue
+                    try:
+                        moved[item.image] = self.bot.blobs.adopt(item.image)
+                    except OSError:
+                        traceback.print_exc()
+                        continue
+                item.image = moved[item.image]
+                self.storage.save_item(item)
+
+    def __unload(self):
+        # the blob store outlives the cog. a reload will reference the images again.
+        for i in self._items:
+            if i is not None:
+                self.bot.blobs.deref(i.image)
+        self.storage.close()
+
+    def as_json(self):
+        """json safe value."""
+        return {"tags": {name: list(ids) for name, ids in self._tags.items()},
+                "items": [None if i is None else i.as_json() for i in self._items]}
 
-    def get(self, message, item, predicate=None):
+    def selection_mode(self, name: str, server=None):
+        """The selection mode used for a tag. A mode set for the tag wins over the server's mode."""
+        mode = self.bot.status.get('tag_selection', {}).get(name)
+        if mode is None and server is not None:
+            mode = self.bot.server_configs.get(server.id, {}).get('tag_selection')
+        return mode or 'random'
+
+    def get(self, message, item, predicate=None, view=None):
+        """Get an item from a tag, chosen according to the tag's selection mode.
+
+        view narrows the choice to a precomputed view, such as 'static' or 'gif'. See TagItem.views.
+        predicate is checked against every item in the tag, so prefer a view where one fits."""
         if item not in self._tags:
             raise KeyError
+        items = self._tags[item] if view is None else self._views.get((item, view), ())
         if predicate is not None:
-            items = [x for x in self._tags[item] if predicate(self._items[x])]
+            items = [x for x in items if predicate(self._items[x])]
+            if len(items) == 0:
+                return None
+            i = random.choice(items)
         else:
-            items = self._tags[item]
-        if len(items) == 0:
-            return None
+            if len(items) == 0:
+                return None
+            mode = self.selection_mode(item, message.server)
+            key = (item, view, mode)
+            if key not in self._selectors:
+                self._selectors[key] = Selector(mode, self._uses, self._items)
+            i = self._selectors[key].pick(items)
+        self._uses[i] += 1
         self.bot.inc_use(message.author.id, "tag " + item)
-        return self._items[random.choice(items)]
+        return self._items[i]
 
     def __setitem__(self, key, value):
-        """Add a new item and assign it a tag."""
-        try:
-            index = next((i for i, x in enumerate(self._items) if x is None))
-            value.id = index
+        """Add a new item and assign it a tag. Reuses the smallest free id if there is one."""
+        if self._free:
+            index = heapq.heappop(self._free)
             self._items[index] = value
-        except StopIteration:
+        else:
             index = len(self._items)
-            value.id = index
             self._items.append(value)
-            self._items.append(None)
-        self._tags[key.lower()].append(index)
-        self.dump()
+        value.id = index
+        self.bot.blobs.ref(value.image)
+        self._link(key.lower(), index)
+        self.storage.save_item(value)
+        self.storage.add_link(key.lower(), index)
 
     def __len__(self):
         return len(self._items)
@@ -205,44 +581,110 @@ class TagMap:
         """List of all tags."""
         return self._tags.keys()
 
+    def _link(self, name: str, item_id: int):
+        if name not in self._tags:
+            self._tags[name] = utils.IndexedSet()
+        self._tags[name].add(item_id)
+        self._item_tags[item_id].add(name)
+        if item_id not in self._item_views:
+            self._item_views[item_id] = self._items[item_id].views()
+        for v in self._item_views[item_id]:
+            if (name, v) not in self._views:
+                self._views[(name, v)] = utils.IndexedSet()
+            self._views[(name, v)].add(item_id)
+
+    def _unlink(self, name: str, item_id: int):
+        self._item_tags[item_id].discard(name)
+        ids = self._tags.get(name)
+        if ids is not None:
+            ids.discard(item_id)
+            if len(ids) == 0:
+                del self._tags[name]
+                self._selectors = {k: v for k, v in self._selectors.items() if k[0] != name}
+        for v in self._item_views.get(item_id, ()):
+            ids = self._views.get((name, v))
+            if ids is not None:
+                ids.discard(item_id)
+                if len(ids) == 0:
+                    del self._views[(name, v)]
+
+    def _reindex(self, item_id: int):
+        """Update the views of an item after its image or method changed."""
+        names = list(self._item_tags[item_id])
+        for name in names:
+            self._unlink(name, item_id)
+        self._item_views.pop(item_id, None)
+        for name in names:
+            self._link(name, item_id)
+
     def add_tag(self, item_id: int, name: str):
         """Add a tag to an already existing item. If an item already has that tag, it will not be duplicated."""
         if name in self.get_by_id(item_id).tags:
             return
         self._items[item_id].tags.append(name)
-        if name not in self._tags:
-            self._tags[name] = []
-        self._tags[name].append(item_id)
-        self.dump()
+        self._link(name, item_id)
+        self.storage.save_item(self._items[item_id])
+        self.storage.add_link(name, item_id)
 
     def remove_tag(self, name: str):
         """remove a tag from the database. does not remove the items tagged with it unless they have 0 tags left."""
-        items = self._tags.pop(name)
-        for item in items:
-            self._items[item].tags.remove(name)
-            if len(self._items[item].tags) == 0:
-                self.delete(item)
-        self.dump()
+        with self.batch():
+            for item in list(self._tags[name]):
+                self._unlink(name, item)
+                t = self._items[item]
+                if name in t.tags:
+                    t.tags.remove(name)
+                self.storage.remove_link(name, item)
+                if len(t.tags) == 0 or len(self._item_tags[item]) == 0:
+                    self.delete(item)
+                else:
+                    self.storage.save_item(t)
+
+    def remove_item_tag(self, item_id: int, name: str):
+        """Remove a tag from a single item. The item is removed if it has 0 tags left."""
+        t = self.get_by_id(item_id)
+        t.tags.remove(name)
+        if name in self._item_tags[item_id]:
+            self._unlink(name, item_id)
+            self.storage.remove_link(name, item_id)
+        if len(t.tags) == 0:
+            self.delete(item_id)
+        else:
+            self.storage.save_item(t)
 
     def delete(self, item: int):
-        for t in self.get_by_id(item).tags:
-            self._tags[t] = [x for x in self._tags[t] if x != item]
+        """Remove an item. Only the tags that contain it are touched."""
+        self.get_by_id(item)
+        for name in list(self._item_tags[item]):
+            self._unlink(name, item)
+        del self._item_tags[item]
+        self._item_views.pop(item, None)
+        # the id is reused for new items, which shouldn't inherit this one's history.
+        self._uses.pop(item, None)
+        for s in self._selectors.values():
+            s.forget(item)
+        self.bot.blobs.deref(self._items[item].image)
         self._items[item] = None
-        d = defaultdict(list)
-        d.update({t: self._tags[t] for t in self._tags if len(self._tags[t]) > 0})
-        self._tags = d
-        self.dump()
+        heapq.heappush(self._free, item)
+        self.storage.delete_item(item)
 
     def get_all_tag(self, name: str):
         """Get all items with a specific tag."""
         return self._tags[name]
 
-    def get_items(self, *names, pred=lambda _: True):
-        """Get all items with a specific tag matching a predicate."""
+    def get_items(self, *names, pred=lambda _: True, view=None):
+        """Get all items with a specific tag matching a predicate, optionally narrowed to a view."""
         if any(name not in self._tags for name in names):
             raise KeyError
-        ts = sum([self._tags[name] for name in names], [])
-        return [self._items[i] for i in ts if pred(self._items[i])]
+        return [self._items[i] for name in names
+                for i in (self._tags[name] if view is None else self._views.get((name, view), ()))
+                if pred(self._items[i])]
+
+    def count(self, name: str, view=None):
+        """The amount of items in a tag, optionally narrowed to a view."""
+        if view is None:
+            return len(self._tags.get(name, ()))
+        return len(self._views.get((name, view), ()))
 
     def get_by_id(self, item_id: int):
         """Get an item by its unique id."""
@@ -253,8 +695,39 @@ class TagMap:
 
     def set_by_id(self, item_id: int, item):
         """Set an item by its unique id."""
+        if self._items[item_id] is not None:
+            self.bot.blobs.deref(self._items[item_id].image)
+        self.bot.blobs.ref(item.image)
         self._items[item_id] = item
-        self.dump()
+        self._reindex(item_id)
+        self.storage.save_item(item)
+
+    def save_item(self, item_id: int):
+        """Save changes made to an item's fields."""
+        self._reindex(item_id)
+        self.storage.save_item(self.get_by_id(item_id))
+
+    def set_image(self, item_id: int, image: str=None):
+        """Change the image of an item, keeping blob references up to date."""
+        t = self.get_by_id(item_id)
+        self.bot.blobs.deref(t.image)
+        self.bot.blobs.ref(image)
+        t.image = image
+        self.save_item(item_id)
+
+    def batch(self):
+        """Context manager grouping many changes into one write to storage."""
+        return self.storage.batch()
+
+    def compact(self):
+        """Reclaim the free ids at the end of the item list. Returns the amount reclaimed."""
+        n = len(self._items)
+        while self._items and self._items[-1] is None:
+            self._items.pop()
+        self._free = [i for i in self._free if i < len(self._items)]
+        heapq.heapify(self._free)
+        self.storage.compact()
+        return n - len(self._items)
 
     async def on_reaction_add(self, reaction, user):
         """Allow users to react to messages with 🏷 ️to add them to the database. Will prompt user for tags."""
@@ -292,22 +765,20 @@ class TagMap:
     @tag.command(name='list')
     async def _tag_list(self, name: str=None, typ: str=None):
         """List the available tags. Or all the ids with a particular tag."""
-        types = ('.png', '.jpg', '.jpeg')
-
         if name not in self._tags and not typ:
             typ = name
             name = None
 
         if typ == 'images':
-            pred = lambda ta: ta.image and ta.image.endswith(types)
+            view = 'static'
         elif typ is None:
-            pred = lambda _: True
+            view = None
         else:
             raise commands.BadArgument("unrecognized type or tag")
 
         if name:
             try:
-                ts = self.get_items(name, pred=pred)
+                ts = sorted(self.get_items(name, view=view), key=lambda ta: ta.id)
             except KeyError:
                 commands.BadArgument("Not found.")
             if ts:
@@ -328,9 +799,9 @@ class TagMap:
                 await self.bot.say("None found.")
         else:
             await self.bot.say("Tags: " + ", ".join(
-                [f'{t}({len(self.get_items(t, pred=pred))})'
+                [f'{t}({self.count(t, view)})'
                  for t in sorted(self.taglist)
-                 if len(self.get_items(t, pred=pred))]
+                 if self.count(t, view)]
             ))
 
     @tag.group(pass_context=True, name='add', invoke_without_command=True)
@@ -349,11 +820,7 @@ class TagMap:
             return
         i_path = None
         if len(ctx.message.attachments) > 0:
-            async with aiohttp.ClientSession() as session:
-                link = ctx.message.attachments[0]['url']
-                n = "{}.{}".format(str(hash(link[-10:])), link.split('.')[-1])
-                await utils.download(session, link, os.path.join('images', n))
-                i_path = os.path.join('images', n)
+            i_path = await self.bot.blobs.download(self.session, ctx.message.attachments[0]['url'])
         if text == '' and i_path is None:
             await self.bot.say("Can not create empty tag.")
             return
@@ -400,11 +867,7 @@ class TagMap:
         async for m in messages:
             i_path = None
             if len(m.attachments) > 0:
-                async with aiohttp.ClientSession() as session:
-                    link = m.attachments[0]['url']
-                    n = "{}.{}".format(str(hash(link[-10:])), link.split('.')[-1])
-                    await utils.download(session, link, os.path.join('images', n))
-                    i_path = os.path.join('images', n)
+                i_path = await self.bot.blobs.download(self.session, m.attachments[0]['url'])
             t = TagItem(m.author.id, str(ctx.message.timestamp), ts, text=m.content, image=i_path)
             self[ts[0]] = t
             for name in ts[1:]:
@@ -543,7 +1006,7 @@ class TagMap:
         """credit a tag to a user."""
         try:
             self.get_by_id(item_id).author = user.id
-            self.dump()
+            self.save_item(item_id)
             await self.get_by_id(item_id).run(ctx)
         except IndexError:
             await self.bot.say("id not found.")
@@ -554,7 +1017,7 @@ class TagMap:
         """Claim a tag. Useful for tags imported from before author was tracked, or tags readded by others."""
         try:
             self.get_by_id(item_id).author = ctx.message.author.id
-            self.dump()
+            self.save_item(item_id)
             await self.get_by_id(item_id).run(ctx)
         except IndexError:
             await self.bot.say("id not found.")
@@ -578,14 +1041,58 @@ class TagMap:
             if len(tags) > 0:
                 for name in tags:
                     if name in t.tags:
-                        t.tags.remove(name)
+                        self.remove_item_tag(t.id, name)
                     else:
                         await self.bot.say("id {} does not have {}.".format(target, name))
-                if len(t.tags) == 0:
-                    self.delete(int(target))
             else:
                 self.delete(int(target))
-        self.dump()
+
+    @tag.command(name='mode')
+    @checks.is_owner()
+    async def _tag_mode(self, name: str, mode: str=None):
+        """Set how items are picked from a tag. Overrides the server's mode.
+
+        Modes:
+            random: every item is equally likely.
+            shuffle: no item repeats until every item in the tag has been shown.
+            recent: newer items are more likely.
+            usage: items that have been shown less are more likely.
+        Pass no mode to go back to the server's mode."""
+        modes = self.bot.status.setdefault('tag_selection', {})
+        if mode is None:
+            modes.pop(name, None)
+        elif mode in Selector.modes:
+            modes[name] = mode
+        else:
+            raise commands.BadArgument(f'Modes: {", ".join(Selector.modes)}')
+        self.bot.dump_status()
+        await self.bot.affirmative()
+
+    @tag.command(pass_context=True, name='servermode', no_pm=True)
+    @checks.is_moderator()
+    async def _tag_servermode(self, ctx, mode: str=None):
+        """Set how items are picked from tags in this server. See tag mode for the available modes."""
+        config = self.bot.server_configs.setdefault(ctx.message.server.id, {})
+        if mode is None:
+            config.pop('tag_selection', None)
+        elif mode in Selector.modes:
+            config['tag_selection'] = mode
+        else:
+            raise commands.BadArgument(f'Modes: {", ".join(Selector.modes)}')
+        self.bot.dump_server_configs()
+        await self.bot.affirmative()
+
+    @tag.command(name='gc')
+    @checks.is_owner()
+    async def _tag_gc(self):
+        """Delete stored images that no tag uses anymore."""
+        await self.bot.say(f'Deleted {self.bot.blobs.collect()} unused images.')
+
+    @tag.command(name='compact')
+    @checks.is_owner()
+    async def _tag_compact(self):
+        """Reclaim unused ids at the end of the database."""
+        await self.bot.say(f'Reclaimed {self.compact()} ids.')
 
     @tag.command(pass_context=True, name='edit')
     @request()
@@ -596,14 +1103,9 @@ class TagMap:
         try:
             self.get_by_id(item_id).text = content
             if len(ctx.message.attachments) > 0:
-                async with aiohttp.ClientSession() as session:
-                    link = ctx.message.attachments[0]['url']
-                    n = "{}.{}".format(str(hash(link[-10:])), link.split('.')[-1])
-                    await utils.download(session, link, os.path.join('images', n))
-                    self.get_by_id(item_id).image = os.path.join('images', n)
+                self.set_image(item_id, await self.bot.blobs.download(self.session, ctx.message.attachments[0]['url']))
             else:
-                self.get_by_id(item_id).image = None
-            self.dump()
+                self.set_image(item_id, None)
         except IndexError:
             await self.bot.say("Response id not found.")
             return
@@ -615,7 +1117,7 @@ class TagMap:
         """Set the method a tag uses."""
         try:
             self.get_by_id(item_id).method = method
-            self.dump()
+            self.save_item(item_id)
         except IndexError:
             await self.bot.say("Response id not found.")
             return
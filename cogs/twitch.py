@@ -98,15 +98,15 @@ class Twitch(utils.SessionCog):
         headers = {"accept": "application:vnd.twitchtv.v5+json", "Client-ID": utils.tokens['twitch_id']}
         url = 'https://api.twitch.tv/kraken/search/channels'
         params = {'query': twitch_username}
-        async with self.session.get(url=url, headers=headers, params=params) as r:
-            chan = (await r.json())['channels'][0]
-            if await self.bot.confirm(f"Closest account found: <{chan['url']}>\nIs this correct?"):
-                await self.bot.profiles.put_by_id(ctx.message.author.id, 'twitch', {
-                    'name': twitch_username.lower(),
-                    'id': chan['_id']
-                })
-                await self.send_listen()
-                await self.bot.affirmative()
+        r = await self.session.cached(url, ttl=300, headers=headers, params=params)
+        chan = (await r.json())['channels'][0]
+        if await self.bot.confirm(f"Closest account found: <{chan['url']}>\nIs this correct?"):
+            await self.bot.profiles.put_by_id(ctx.message.author.id, 'twitch', {
+                'name': twitch_username.lower(),
+                'id': chan['_id']
+            })
+            await self.send_listen()
+            await self.bot.affirmative()
 
     @commands.command(pass_context=True)
     @checks.is_server_owner()
@@ -158,8 +158,9 @@ class Twitch(utils.SessionCog):
             # get box art
             api = 'https://api.twitch.tv/kraken/search/games'
             params = {'query': stream["game"]}
-            async with self.session.get(api, params=params, headers=headers) as r:
-                box = (await r.json())['games'][0]['box']['large']
+            # box art rarely changes
+            r = await self.session.cached(api, ttl=86400, params=params, headers=headers)
+            box = (await r.json())['games'][0]['box']['large']
 
             # send messages to each twitch stream if the user is in that server
             for m in messages:
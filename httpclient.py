@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import asyncio
+import traceback
+
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import aiohttp
+
+import utils
+import storage
+
+
+class HttpClient:
+    """A single aiohttp session shared by the whole bot.
+
+    One tuned connection pool means keep-alive connections and cached DNS lookups are reused across cogs.
+    Cogs use it through an HttpSession from `session_for`, which also records per-cog usage."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, limit: int=100, per_host: int=10, timeout: float=30,
+                 keepalive: float=30, cache_size: int=512, cache_dir: str=None, cache_dir_size: int=4096):
+        self.loop = loop
+        self.timeout = timeout
+        self.cache = HttpCache(loop, cache_size, cache_dir, cache_dir_size)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit, use_dns_cache=True, keepalive_timeout=keepalive, loop=loop),
+            loop=loop
+        )
+        self.hosts = defaultdict(lambda: asyncio.Semaphore(per_host, loop=loop))
+        self.metrics = defaultdict(lambda: {'requests': 0, 'errors': 0, 'seconds': 0.0})
+
+    def session_for(self, name: str):
+        """Get a session for a cog. Usage is recorded under its name."""
+        return HttpSession(self, name)
+
+    async def close(self):
+        await self.session.close()
+
+
+class HttpSession:
+    """A cog's view of the shared HttpClient. Has the same request methods as an aiohttp.ClientSession."""
+
+    def __init__(self, client: HttpClient, name: str):
+        self.client = client
+        self.name = name
+
+    def request(self, method: str, url: str, **kwargs):
+        return _Request(self, method, url, kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url: str, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    async def cached(self, url: str, *, ttl: float, params: dict=None, headers: dict=None):
+        """GET a url through the response cache. Returns a CachedResponse.
+
+        Responses are reused for ttl seconds. After that, they are revalidated with ETag or Last-Modified if the
+        server sent them. Concurrent requests for the same url share one fetch. Only 200 responses are cached."""
+        cache = self.client.cache
+        key = cache.key(url, params, headers)
+        if key in cache.inflight:
+            return await asyncio.shield(cache.inflight[key])
+        fut = cache.inflight[key] = self.client.loop.create_future()
+        try:
+            entry = await cache.get(key)
+            if entry is None or not entry.fresh:
+                entry = await self._fetch(key, url, ttl, params, dict(headers or {}), entry)
+            fut.set_result(entry)
+            return entry
+        except Exception as e:
+            fut.set_exception(e)
+            # mark the exception retrieved, in case nobody else was waiting.
+            fut.exception()
+            raise
+        finally:
+            del cache.inflight[key]
+
+    async def _fetch(self, key: str, url: str, ttl: float, params, headers: dict, stale):
+        if stale is not None:
+            if stale.etag:
+                headers['If-None-Match'] = stale.etag
+            if stale.last_modified:
+                headers['If-Modified-Since'] = stale.last_modified
+        async with self.get(url, params=params, headers=headers) as r:
+            if r.status == 304 and stale is not None:
+                stale.expires = time.time() + ttl
+                entry = stale
+            else:
+                entry = CachedResponse(r.status, r.reason, await r.read(), time.time() + ttl,
+                                       r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        if entry.status == 200:
+            await self.client.cache.put(key, entry)
+        return entry
+
+
+class _Request:
+    """A request made through an HttpSession. Use with `async with`.
+
+    Holds one of the host's connection slots until the response is released."""
+
+    def __init__(self, session: HttpSession, method: str, url: str, kwargs: dict):
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.host = self.session.client.hosts[urlparse(url).netloc]
+        self.metrics = self.session.client.metrics[self.session.name]
+        self.response = None
+        self.start = None
+
+    async def __aenter__(self):
+        client = self.session.client
+        await self.host.acquire()
+        self.start = time.monotonic()
+        self.metrics['requests'] += 1
+        try:
+            self.response = await asyncio.wait_for(
+                client.session.request(self.method, self.url, **self.kwargs), client.timeout, loop=client.loop
+            )
+        except Exception:
+            self.metrics['errors'] += 1
+            self.metrics['seconds'] += time.monotonic() - self.start
+            self.host.release()
+            raise
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None or self.response.status >= 400:
+            self.metrics['errors'] += 1
+        self.metrics['seconds'] += time.monotonic() - self.start
+        try:
+            if exc_type is not None:
+                # the body may be half read, so the connection can't be reused.
+                self.response.close()
+            else:
+                await self.response.release()
+        finally:
+            self.host.release()
+
+
+class CachedResponse:
+    """A response body held by the cache. Has the reading methods of an aiohttp response."""
+
+    def __init__(self, status: int, reason: str, body: bytes, expires: float, etag: str=None,
+                 last_modified: str=None):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires
+
+    async def read(self):
+        return self.body
+
+    async def text(self, encoding: str='utf-8'):
+        return self.body.decode(encoding, errors='replace')
+
+    async def json(self):
+        return json.loads(await self.text())
+
+    def as_json(self):
+        """json safe value."""
+        return {
+            'status': self.status,
+            'reason': self.reason,
+            'body': base64.b64encode(self.body).decode(),
+            'expires': self.expires,
+            'etag': self.etag,
+            'last_modified': self.last_modified
+        }
+
+    @classmethod
+    def from_json(cls, data: dict):
+        data['body'] = base64.b64decode(data['body'])
+        return cls(**data)
+
+
+class HttpCache:
+    """Response cache for HttpSession.cached.
+
+    Keeps an LRU in memory, backed by an optional directory on disk that survives restarts.
+    Disk reads and writes happen in an executor.
+    Each file's mtime is set to its expiry. Every so many writes the directory is pruned of expired files,
+    and of the ones closest to expiring while it holds more than `disk_size` of them."""
+
+    # params that don't change the response, like short lived tokens. left out of cache keys.
+    ignored_params = ('access_token',)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, size: int, directory: str=None, disk_size: int=4096):
+        self.loop = loop
+        self.memory = utils.LRU(size)
+        self.directory = directory
+        self.disk_size = disk_size
+        # writes until the next prune. the first write prunes what earlier runs left behind.
+        self.prune_in = 0
+        self.inflight = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, url: str, params: dict=None, headers: dict=None):
+        params = sorted((k, str(v)) for k, v in (params or {}).items() if k not in self.ignored_params)
+        headers = sorted((headers or {}).items())
+        return hashlib.sha1(json.dumps([url, params, headers]).encode()).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _read(self, key: str):
+        try:
+            with open(self._path(key)) as f:
+                return CachedResponse.from_json(json.load(f))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _write(self, key: str, entry: CachedResponse):
+        fn = self._path(key)
+        storage.atomic_write(fn, json.dumps(entry.as_json()))
+        os.utime(fn, (entry.expires, entry.expires))
+
+    def _prune(self):
+        now = time.time()
+        entries = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, fn)
+            try:
+                expires = os.path.getmtime(path)
+                if expires < now:
+                    os.remove(path)
+                else:
+                    entries.append((expires, path))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.disk_size)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key: str):
+        entry = self.memory.get(key)
+        if entry is None and self.directory is not None:
+            entry = await self.loop.run_in_executor(None, self._read, key)
+            if entry is not None:
+                self.memory[key] = entry
+        return entry
+
+    async def put(self, key: str, entry: CachedResponse):
+        self.memory[key] = entry
+        if self.directory is not None:
+            try:
+                await self.loop.run_in_executor(None, self._write, key, entry)
+                self.prune_in -= 1
+                if self.prune_in <= 0:
+                    self.prune_in = max(1, self.disk_size // 8)
+                    await self.loop.run_in_executor(None, self._prune)
+            except OSError:
+                # the memory tier still has it.
+                traceback.print_exc()
@@ -0,0 +1,46 @@
+import time
+import asyncio
+
+from functools import partial
+
+import pyimgur
+
+import utils
+
+
+class AsyncImgur:
+    """Awaitable wrapper around pyimgur.
+
+    pyimgur does blocking http requests, so every call runs in an executor.
+    Album and gallery listings change rarely and are cached for `ttl` seconds."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client_id: str, client_secret: str, ttl: float=600,
+                 cache_size: int=256):
+        self.loop = loop
+        self.imgur = pyimgur.Imgur(client_id, client_secret)
+        self.ttl = ttl
+        # (method, args) -> (expiry, result)
+        self.cache = utils.LRU(cache_size)
+
+    def _run(self, fcn, *args, **kwargs):
+        return self.loop.run_in_executor(None, partial(fcn, *args, **kwargs))
+
+    async def _cached(self, fcn, *args, **kwargs):
+        key = (fcn.__name__, args, tuple(sorted(kwargs.items())))
+        expires, result = self.cache.get(key, (0, None))
+        if expires < time.monotonic():
+            result = await self._run(fcn, *args, **kwargs)
+            self.cache[key] = (time.monotonic() + self.ttl, result)
+        return result
+
+    async def get_album(self, album_id: str) -> pyimgur.Album:
+        return await self._cached(self.imgur.get_album, album_id)
+
+    async def get_at_url(self, url: str):
+        return await self._cached(self.imgur.get_at_url, url)
+
+    async def get_subreddit_gallery(self, subreddit: str, sort: str='time', window: str='top', limit: int=None):
+        return await self._cached(self.imgur.get_subreddit_gallery, subreddit, sort=sort, window=window, limit=limit)
+
+    async def get_image(self, image_id: str) -> pyimgur.Image:
+        return await self._run(self.imgur.get_image, image_id)
@@ -0,0 +1,305 @@
+import os
+import math
+import time
+import bisect
+import asyncio
+import itertools
+
+from collections import defaultdict
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image, ImageFont, ImageDraw, ImageSequence, GifImagePlugin
+
+
+# Jobs describe the work to be done and are sent to the worker processes, so everything in them must be picklable.
+
+# Decode an image (path or bytes) and scale it to a height, no wider than max_width. Returns the Image.
+# `thumbnail` is an optional (path, height) to read a smaller copy of the source from, created there if missing.
+DecodeJob = namedtuple('DecodeJob', 'source height max_width thumbnail')
+# Fit rows of decoded images to a width and paste them together.
+CollageJob = namedtuple('CollageJob', 'rows width min_row_width line_width')
+# Write a name on the baka template.
+BakaJob = namedtuple('BakaJob', 'text template font')
+# Paste circular faces onto the template file. `faces` holds a (key, image bytes) pair for each (x, y, size) in
+# `coords`. The key identifies the image, so workers can reuse faces they have already prepared.
+OverlayJob = namedtuple('OverlayJob', 'template faces coords gif')
+
+# The output of a render job. `data` is the encoded file and `ext` its extension.
+Rendered = namedtuple('Rendered', 'data ext')
+
+
+def _open(source):
+    return Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+
+
+def _encode(im: Image.Image, fmt: str, **kwargs) -> bytes:
+    with BytesIO() as fp:
+        im.save(fp, fmt, **kwargs)
+        return fp.getvalue()
+
+
+def _scale(im: Image.Image, height: int) -> Image.Image:
+    # let jpeg decoding skip detail that would be thrown away by the resize.
+    im.draft('RGB', (im.size[0] * height // im.size[1], height))
+    im = im.convert('RGB')
+    if im.size[1] == height:
+        return im
+    return im.resize((max(1, im.size[0] * height // im.size[1]), height), Image.ANTIALIAS)
+
+
+def _thumbnail(source, fn: str, height: int) -> Image.Image:
+    try:
+        return Image.open(fn)
+    except FileNotFoundError:
+        im = _scale(_open(source), height)
+        # unique temporary name, as another worker may be making the same thumbnail.
+        tmp = f'{fn}.{os.getpid()}.tmp'
+        im.save(tmp, 'JPEG', quality=90)
+        os.replace(tmp, fn)
+        return im
+
+
+def decode(job: DecodeJob) -> Image.Image:
+    if job.thumbnail is not None:
+        im = _scale(_thumbnail(job.source, *job.thumbnail), job.height)
+    else:
+        im = _scale(_open(job.source), job.height)
+    im.thumbnail((job.max_width, job.height))
+    return im
+
+
+def collage(job: CollageJob) -> Rendered:
+    rows = [list(ims) for ims in job.rows]
+    line_width = job.line_width
+
+    # remove last row if below minimum.
+    if len(rows) > 1 and sum(i.size[0] for i in rows[-1]) + line_width * (len(rows[-1]) - 1) < job.min_row_width:
+        del rows[-1]
+
+    # fit each row to width
+    for n, ims in enumerate(rows):
+        row_width = sum(i.size[0] for i in ims)
+        if row_width + line_width * (len(ims) - 1) != job.width:
+            scale = job.width / row_width
+            rows[n] = [i.resize([int(d * scale) for d in i.size], Image.ANTIALIAS) for i in ims]
+
+    # get the actual output height
+    out_height = sum(ims[0].size[1] for ims in rows) + ((len(rows) - 1) * line_width)
+
+    # create new Image object
+    image = Image.new('RGB', (job.width, int(out_height)))
+
+    # draw images on output image
+    y = 0
+    for ims in rows:
+        x = 0
+        for i in ims:
+            image.paste(i, (x, y))
+            x += i.size[0] + line_width
+        y += ims[0].size[1] + line_width
+
+    return Rendered(_encode(image, 'PNG'), 'png')
+
+
+# assets are loaded once per worker process.
+
+@lru_cache(maxsize=8)
+def _font(fn: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(fn, size)
+
+
+@lru_cache(maxsize=32)
+def _template(fn: str) -> Image.Image:
+    im = Image.open(fn)
+    im.load()
+    return im
+
+
+def baka(job: BakaJob) -> Rendered:
+    t = job.text[:7] + '...' if len(job.text) > 10 else job.text
+    i = 'you idiot...'
+    f = _font(job.font, 12)
+    # the cached template is shared, so draw on a copy.
+    im = _template(job.template).copy()
+    d = ImageDraw.Draw(im)
+    tw, th = d.textsize(t, f)
+    iw, ih = d.textsize(i, f)
+    d.text((250 - (tw // 2), 125 - (th // 2)), t, (0, 0, 0), font=f)
+    d.text((255 - (iw // 2), 150 - (ih // 2)), i, (0, 0, 0), font=f)
+    return Rendered(_encode(im, 'PNG'), 'png')
+
+
+# limits for animated overlays
+gif_max_frames = 120
+gif_max_pixels = 64 * 1000 * 1000
+# the output loops over the lcm of the faces' loops, unless that is longer than this. then it uses the longest loop.
+gif_max_duration = 10000
+gif_min_delay = 20
+# quantize every frame to the first frame's palette, for smaller output. colors that only show up in later
+# frames are then approximated. by default each frame gets its own local color table.
+gif_shared_palette = False
+gif_loop = b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+
+# faces scaled for a coordinate, by (key, size, gif)
+_faces = OrderedDict()
+_faces_size = 64
+
+
+@lru_cache(maxsize=64)
+def _mask(size: tuple) -> Image.Image:
+    # drawn large and scaled down for smooth edges.
+    mask = Image.new("L", [d * 4 for d in size], color=0)
+    ImageDraw.Draw(mask).ellipse((0, 0) + mask.size, fill=255)
+    return mask.resize(size, Image.ANTIALIAS)
+
+
+def _face(key: str, data: bytes, size: int, gif: bool) -> list:
+    """A face scaled to fit a size, as a list of (frame, mask, duration).
+
+    Only animated faces in gifs have several frames, at most gif_max_frames of them."""
+    k = (key, size, gif)
+    if k in _faces:
+        _faces.move_to_end(k)
+        return _faces[k]
+    face = _open(data)
+    frames = []
+    for f in ImageSequence.Iterator(face) if gif and face.format == 'GIF' else [face]:
+        duration = max(gif_min_delay, f.info.get('duration') or 100)
+        f = f.copy()
+        f.thumbnail((size, size), Image.ANTIALIAS)
+        frames.append((f, _mask(f.size), duration))
+        if len(frames) == gif_max_frames:
+            break
+    _faces[k] = frames
+    if len(_faces) > _faces_size:
+        _faces.popitem(last=False)
+    return frames
+
+
+def _paste(im: Image.Image, face: Image.Image, mask: Image.Image, c):
+    im.paste(face, (c[0] - face.size[0] // 2, c[1] - face.size[1] // 2), mask)
+
+
+def _timeline(faces: list, size: tuple) -> tuple:
+    """Delay and amount of frames for animating faces, within the frame and pixel budgets."""
+    loops = [sum(d for _, _, d in face) for face in faces]
+    total = 1
+    for loop in loops:
+        total = total * loop // math.gcd(total, loop)
+    if total > gif_max_duration:
+        total = max(loops)
+    # gif delays are in hundredths of a second.
+    delay = math.ceil(min(d for face in faces for _, _, d in face) / 10) * 10
+    budget = max(1, min(gif_max_frames, gif_max_pixels // (size[0] * size[1])))
+    if math.ceil(total / delay) > budget:
+        delay = math.ceil(total / budget / 10) * 10
+    return delay, math.ceil(total / delay)
+
+
+def _encode_gif(base: Image.Image, animated: list) -> bytes:
+    """Encode the animated faces over the base image, one frame at a time.
+
+    Frames are composited as they are encoded, so only one frame is in memory.
+    Each frame is quantized on its own and written with a local color table, unless gif_shared_palette is set."""
+    if not animated:
+        return _encode(base, 'GIF')
+    delay, count = _timeline([face for face, _ in animated], base.size)
+    # end time of each frame, for finding the frame shown at a time.
+    ends = [list(itertools.accumulate(d for _, _, d in face)) for face, _ in animated]
+    base = base.convert('RGB')
+    palette = None
+    with BytesIO() as fp:
+        for n in range(count):
+            frame = base.copy()
+            for (face, c), end in zip(animated, ends):
+                p, m, _ = face[min(bisect.bisect_right(end, n * delay % end[-1]), len(face) - 1)]
+                _paste(frame, p, m, c)
+            if palette is None:
+                frame = palette = frame.quantize(256)
+                fp.write(b''.join(GifImagePlugin.getheader(frame)[0]))
+                fp.write(gif_loop)
+            elif gif_shared_palette:
+                frame = frame.quantize(palette=palette)
+            else:
+                frame = frame.quantize(256)
+            for chunk in GifImagePlugin.getdata(frame, duration=delay, include_color_table=not gif_shared_palette):
+                fp.write(chunk)
+        fp.write(b';')
+        return fp.getvalue()
+
+
+def overlay(job: OverlayJob) -> Rendered:
+    im = _template(job.template).copy()
+    animated = []
+
+    # paste each face. animated faces are pasted per frame while encoding.
+    for (key, data), c in zip(job.faces, job.coords):
+        face = _face(key, data, c[2], job.gif)
+        if len(face) == 1:
+            _paste(im, face[0][0], face[0][1], c)
+        else:
+            animated.append((face, c))
+
+    if job.gif:
+        return Rendered(_encode_gif(im, animated), 'gif')
+    return Rendered(_encode(im, 'PNG'), 'png')
+
+
+renderers = {
+    DecodeJob: decode,
+    CollageJob: collage,
+    BakaJob: baka,
+    OverlayJob: overlay
+}
+
+
+def run(job):
+    """Entry point in the worker processes."""
+    return renderers[type(job)](job)
+
+
+class RenderService:
+    """Runs render jobs in a pool of worker processes, so Pillow work never blocks the event loop.
+
+    At most `queue_size` jobs are handed to the pool at once. Further jobs wait for a free slot,
+    so a burst of commands can't pile up unbounded work and memory in the pool's queue.
+    If a worker dies, e.g. killed for running out of memory, the pool is replaced and only the jobs it held fail."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int=2, queue_size: int=8):
+        self.loop = loop
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.slots = asyncio.Semaphore(queue_size, loop=loop)
+        self.metrics = defaultdict(lambda: {'jobs': 0, 'errors': 0, 'waiting': 0.0, 'seconds': 0.0})
+
+    async def render(self, job):
+        """Run a job in a worker process and return its result."""
+        metrics = self.metrics[type(job).__name__]
+        queued = time.monotonic()
+        async with self.slots:
+            start = time.monotonic()
+            metrics['waiting'] += start - queued
+            pool = self.pool
+            try:
+                return await self.loop.run_in_executor(pool, run, job)
+            except BrokenProcessPool:
+                metrics['errors'] += 1
+                # other jobs on the broken pool fail too, only the first of them replaces it.
+                if self.pool is pool:
+                    pool.shutdown(wait=False)
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                raise
+            except Exception:
+                metrics['errors'] += 1
+                raise
+            finally:
+                metrics['jobs'] += 1
+                metrics['seconds'] += time.monotonic() - start
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,323 @@
+import os
+import re
+import json
+import time
+import asyncio
+import traceback
+import uuid
+import hashlib
+
+from collections import Counter
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import utils
+
+
+def atomic_write(fn: str, data: str):
+    """Write a file by writing a temporary file next to it and renaming it over the original.
+
+    A crash mid-write leaves the old file intact instead of a truncated one."""
+    tmp = f'{fn}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fn)
+
+
+class Persistence:
+    """Write-behind persistence for json stores.
+
+    Stores register a path and a callable returning their json-safe data.
+    Marking a store dirty schedules a flush after `flush_window` seconds, so many changes in a short time
+    result in a single write. The data is serialized on the loop, so it is a consistent snapshot,
+    and the file is written in an executor."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, flush_window: float = 5.0):
+        self.loop = loop
+        self.flush_window = flush_window
+        self._stores = {}
+        self._dirty = set()
+        self._task = None
+        self._lock = asyncio.Lock(loop=loop)
+
+    def register(self, name: str, path: str, data, before=None, after=None):
+        """Register a store. `data` is called with no arguments and should return the object to be saved.
+
+        `before` and `after` are optional callables run on the loop around each write.
+        `before` runs immediately before the data is serialized, with nothing else running in between."""
+        self._stores[name] = (path, data, before, after)
+
+    def unregister(self, name: str):
+        """Unregister a store, writing it immediately if it has unsaved changes."""
+        if name in self._dirty:
+            self._dirty.discard(name)
+            self._write_now(name)
+        self._stores.pop(name, None)
+
+    def mark_dirty(self, name: str):
+        """Mark a store as changed. It will be written at the end of the current flush window."""
+        self._dirty.add(name)
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_window)
+        # changes made while flushing need a new flush scheduled.
+        self._task = None
+        await self.flush()
+
+    def _snapshot(self, name: str):
+        path, data, before, _ = self._stores[name]
+        if before is not None:
+            before()
+        return path, json.dumps(data(), ensure_ascii=True)
+
+    def _write_now(self, name: str):
+        atomic_write(*self._snapshot(name))
+        after = self._stores[name][3]
+        if after is not None:
+            after()
+
+    async def flush(self, *names):
+        """Write dirty stores now. Writes all dirty stores if no names are passed."""
+        async with self._lock:
+            pending = [n for n in (names or list(self._dirty)) if n in self._dirty and n in self._stores]
+            for name in pending:
+                if name not in self._stores:
+                    # unregistered while an earlier store was being written.
+                    continue
+                self._dirty.discard(name)
+                path, data = self._snapshot(name)
+                after = self._stores[name][3]
+                try:
+                    await self.loop.run_in_executor(None, atomic_write, path, data)
+                except OSError:
+                    print(f'Error writing {name}:')
+                    traceback.print_exc()
+                    self.mark_dirty(name)
+                else:
+                    if after is not None:
+                        after()
+
+
+class Journal:
+    """Append-only journal of changes to a store, one json record per line.
+
+    Records are appended as changes happen and replayed over the last snapshot on startup.
+    The journal must be rotated aside at the same moment the snapshot is taken, with no changes in between,
+    so the rotated part holds exactly the changes the snapshot includes. It is discarded once the snapshot
+    is safely on disk. Records appended after that moment go to the new journal, which the snapshot lacks,
+    so each change is replayed exactly once. This keeps the cost of recording a change constant regardless
+    of store size."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rotated = f'{path}.1'
+        self.size = 0
+        self._fp = None
+
+    def replay(self):
+        """Yield every record in the rotated and current journal, oldest first."""
+        for fn in (self.rotated, self.path):
+            try:
+                with open(fn) as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            # a torn last line from a crash mid-append.
+                            break
+            except FileNotFoundError:
+                pass
+
+    def append(self, record):
+        """Add a record to the end of the journal."""
+        if self._fp is None:
+            self._fp = open(self.path, 'a', buffering=1)
+        self._fp.write(json.dumps(record, ensure_ascii=True, separators=(',', ':')) + '\n')
+        self.size += 1
+
+    def rotate(self):
+        """Move the current journal aside. Called before a snapshot of the store is taken."""
+        self.close()
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.rotated):
+            # the previous snapshot never finished. keep its records along with these.
+            with open(self.rotated, 'a') as out, open(self.path) as f:
+                for line in f:
+                    out.write(line)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.rotated)
+        self.size = 0
+
+    def discard_rotated(self):
+        """Remove the rotated journal. Called once the snapshot is written."""
+        try:
+            os.remove(self.rotated)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class UsageCounter:
+    """In-memory aggregator for command usage counts.
+
+    Increments are collected here and periodically merged into the stores they belong to,
+    instead of each one modifying and saving the stores directly."""
+
+    def __init__(self):
+        self.total = Counter()
+        self.users = defaultdict(Counter)
+
+    def inc(self, uid: str, fcn: str):
+        self.total[fcn] += 1
+        self.users[uid][fcn] += 1
+
+    def pop_total(self) -> Counter:
+        """Remove and return the pending global counts."""
+        total, self.total = self.total, Counter()
+        return total
+
+    def pop_user(self, uid: str) -> Counter:
+        """Remove and return the pending counts for a single user."""
+        return self.users.pop(uid, Counter())
+
+    def pop_users(self) -> dict:
+        """Remove and return the pending counts for all users."""
+        users, self.users = self.users, defaultdict(Counter)
+        return users
+
+
+class BlobStore:
+    """Content-addressed file store.
+
+    Files are named by the sha256 of their contents and sharded into subdirectories by the leading hex digits,
+    so identical files are stored once no matter where they came from.
+    Reference counts are held in memory. Whatever uses the blobs is expected to `ref` them when loaded."""
+
+    max_size = 32 * 1024 * 1024
+    # blobs added more recently than this are never collected, as whatever added them may not have referenced
+    # them yet.
+    grace_period = 3600
+    # heights of the thumbnails kept next to blobs, and how they are named.
+    thumbnail_heights = (150, 333)
+    thumbnail_re = re.compile(r'^([0-9a-f]{64})\.t\d+\.jpg$')
+    # leading bytes of the image types, and the extensions each is known by. the first is used if the link's
+    # extension is not one of them.
+    signatures = (
+        (b'\x89PNG\r\n\x1a\n', ('.png',)),
+        (b'\xff\xd8\xff', ('.jpg', '.jpeg')),
+        (b'GIF87a', ('.gif',)),
+        (b'GIF89a', ('.gif',)),
+        (b'BM', ('.bmp',)),
+    )
+
+    def __init__(self, root: str):
+        self.root = root
+        self.refs = Counter()
+        os.makedirs(root, exist_ok=True)
+
+    def path_of(self, digest: str, ext: str):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + ext)
+
+    def thumbnail(self, fn: str, height: int):
+        """Where to keep a thumbnail of a blob for scaling it to a height.
+
+        Returns (path, thumbnail height) using the smallest standard height that is large enough,
+        or None if the file is not a blob or is larger than every standard height allows."""
+        if not self.is_blob(fn):
+            return None
+        for h in self.thumbnail_heights:
+            if h >= height:
+                digest = os.path.basename(fn).split('.')[0]
+                return os.path.join(os.path.dirname(fn), f'{digest}.t{h}.jpg'), h
+        return None
+
+    def is_blob(self, fn: str):
+        return fn is not None and os.path.normpath(fn).startswith(os.path.normpath(self.root) + os.sep)
+
+    def extension(self, fn: str, link: str):
+        """The extension to store a file under, from its contents where they are a known image type.
+
+        Falls back to the extension in the link, or none if that doesn't look like one."""
+        ext = os.path.splitext(urlparse(link).path)[1].lower()
+        with open(fn, 'rb') as f:
+            head = f.read(12)
+        for magic, exts in self.signatures:
+            if head.startswith(magic):
+                return ext if ext in exts else exts[0]
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return '.webp'
+        return ext if re.match(r'^\.[a-z0-9]{1,5}$', ext) else ''
+
+    async def download(self, session, link: str):
+        """Download a file into the store. Returns the path of the blob."""
+        tmp = os.path.join(self.root, f'{uuid.uuid4().hex}.tmp')
+        digest = await utils.download(session, link, tmp, max_size=self.max_size)
+        try:
+            ext = self.extension(tmp, link)
+        except OSError:
+            os.remove(tmp)
+            raise
+        return self.add(tmp, digest, ext)
+
+    def adopt(self, fn: str):
+        """Move a file from outside the store into it. Returns the path of the blob."""
+        sha = hashlib.sha256()
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha.update(chunk)
+        return self.add(fn, sha.hexdigest(), self.extension(fn, fn))
+
+    def add(self, fn: str, digest: str, ext: str):
+        """Move an already hashed file into the store. Returns the path of the blob."""
+        dest = self.path_of(digest, ext)
+        if os.path.exists(dest):
+            os.remove(fn)
+            # restart the grace period, so it is not collected before the new user references it.
+            os.utime(dest)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(fn, dest)
+        return dest
+
+    def ref(self, fn: str):
+        if self.is_blob(fn):
+            self.refs[os.path.normpath(fn)] += 1
+
+    def deref(self, fn: str):
+        if self.is_blob(fn):
+            fn = os.path.normpath(fn)
+            self.refs[fn] -= 1
+            if self.refs[fn] <= 0:
+                del self.refs[fn]
+
+    def collect(self):
+        """Delete every blob that is not referenced, along with its thumbnails. Returns the amount deleted.
+
+        Blobs added within the grace period are kept."""
+        removed = 0
+        digests = {os.path.basename(fn).split('.')[0] for fn in self.refs}
+        for d, _, files in os.walk(self.root):
+            for fn in files:
+                if fn.endswith('.tmp'):
+                    # a download or thumbnail in progress.
+                    continue
+                thumbnail = self.thumbnail_re.match(fn)
+                if thumbnail is not None:
+                    if thumbnail.group(1) not in digests:
+                        os.remove(os.path.join(d, fn))
+                    continue
+                fn = os.path.normpath(os.path.join(d, fn))
+                if fn not in self.refs and os.path.getmtime(fn) < time.time() - self.grace_period:
+                    os.remove(fn)
+                    removed += 1
+        return removed
@@ -1,5 +1,6 @@
 import json
-import io
+import hashlib
+import tempfile
 import aiohttp
 import traceback
 import itertools
@@ -9,9 +10,12 @@ import re
 import datetime
 from os import path
 from os import listdir
+from os import remove
 from discord.ext import commands
 from datetime import timedelta
 from collections import defaultdict
+from collections import OrderedDict
+from urllib.parse import urlparse
 
 
 class CheckMsg(commands.CheckFailure):
@@ -35,24 +39,135 @@ def full_command_name(ctx, command):
     return ' '.join(names)
 
 
-async def download(session: aiohttp.ClientSession, link: str, fn: str):
-    """Quick and easy download utility."""
+class DownloadError(OSError):
+    """Raised when a download fails or does not match what was expected.
+
+    transient is set for failures that may go away when retried, like server errors and cut off bodies."""
+
+    def __init__(self, *args, transient: bool=False):
+        super().__init__(*args)
+        self.transient = transient
+
+
+async def stream(session: aiohttp.ClientSession, link: str, fp, *, max_size: int=None, sha256: str=None,
+                 progress=None, chunk_size: int=64 * 1024):
+    """Copy a response into a file object in fixed size chunks, never holding the whole body in memory.
+
+    max_size is the most bytes allowed. sha256 is the expected hex digest, if known.
+    progress is called with the bytes done so far and the total, which is None if the server didn't say
+    or the response is compressed.
+    Returns the sha256 hex digest of the content."""
+    sha = hashlib.sha256()
     async with session.get(link) as r:
-        val = await r.read()
+        if r.status != 200:
+            raise DownloadError(f'{link}: HTTP {r.status}', transient=r.status >= 500 or r.status == 429)
+        total = r.headers.get('Content-Length')
+        # the body is decoded as it is read, so an encoded length doesn't say how much will arrive.
+        if r.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            total = None
+        total = int(total) if total and total.isdigit() else None
+        if max_size is not None and total is not None and total > max_size:
+            raise DownloadError(f'{link}: {total} bytes is over the limit of {max_size}')
+        done = 0
+        while True:
+            chunk = await r.content.read(chunk_size)
+            if not chunk:
+                break
+            done += len(chunk)
+            if max_size is not None and done > max_size:
+                raise DownloadError(f'{link}: over the limit of {max_size} bytes')
+            sha.update(chunk)
+            fp.write(chunk)
+            if progress is not None:
+                progress(done, total)
+    if total is not None and done != total:
+        raise DownloadError(f'{link}: got {done} of {total} bytes', transient=True)
+    digest = sha.hexdigest()
+    if sha256 is not None and digest != sha256.lower():
+        raise DownloadError(f'{link}: hash mismatch')
+    return digest
+
+
+async def download(session: aiohttp.ClientSession, link: str, fn: str, **kwargs):
+    """Quick and easy download utility. Streams to disk and removes the file if the download fails.
+
+    Takes the same keyword arguments as stream, and returns the sha256 hex digest."""
+    try:
         with open(fn, "wb") as f:
-            f.write(val)
+            return await stream(session, link, f, **kwargs)
+    except Exception:
+        if path.exists(fn):
+            remove(fn)
+        raise
 
 
-async def download_fp(session: aiohttp.ClientSession, link: str):
-    """Download to a memory filepointer, instead of disk."""
-    async with session.get(link) as r:
-        fp = io.BytesIO()
-        val = await r.read()
-        fp.write(val)
-        fp.seek(0)
+async def download_fp(session: aiohttp.ClientSession, link: str, spool_size: int=1024 * 1024, **kwargs):
+    """Download to a temporary filepointer instead of a named file.
+
+    It stays in memory up to spool_size bytes and moves to disk beyond that.
+    Takes the same keyword arguments as stream."""
+    fp = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        await stream(session, link, fp, **kwargs)
+    except Exception:
+        fp.close()
+        raise
+    fp.seek(0)
     return fp
 
 
+class DownloadPipeline:
+    """Run many downloads concurrently.
+
+    Limits the total amount running at once and the amount per host,
+    and retries transient failures (timeouts, connection errors, server errors) with exponential backoff.
+    The per host limit defaults to the total, as downloads often all come from one host."""
+
+    def __init__(self, concurrency: int=8, per_host: int=None, retries: int=3, backoff: float=1.0):
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.per_host = concurrency if per_host is None else per_host
+        self.hosts = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        self.retries = retries
+        self.backoff = backoff
+
+    async def _run_one(self, fetch, link: str):
+        host = urlparse(link).netloc
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.concurrency, self.hosts[host]:
+                    return await fetch(link)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    return e
+            except DownloadError as e:
+                if not e.transient or attempt == self.retries:
+                    return e
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # permanent, like failing to store the file. the other downloads carry on.
+                return e
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def run(self, fetch, links, progress=None):
+        """Call the coroutine function fetch on every link.
+
+        Returns the results in the same order as links. Links that failed every retry give their exception instead.
+        progress is called with the amount done and the total after each link finishes."""
+        links = list(links)
+        done = 0
+
+        async def run_one(link):
+            nonlocal done
+            r = await self._run_one(fetch, link)
+            done += 1
+            if progress is not None:
+                progress(done, len(links))
+            return r
+
+        return await asyncio.gather(*[run_one(link) for link in links])
+
+
 def is_command_of(bot, message):
     """Determine if a message is a command of a bot."""
     prefix = bot.command_prefix
@@ -83,14 +198,78 @@ def get_random_file(d: str, s: str, t: str = None):
 
 
 class SessionCog:
-    """Simple class to take care of using a aiohttp session in a cog."""
+    """Simple class to give a cog a session of the bot's shared http client."""
 
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
+        self.session = bot.http_client.session_for(type(self).__name__)
+
+
+class IndexedSet:
+    """A set that also supports indexing, so random.choice works on it.
 
-    def __unload(self):
-        self.bot.loop.create_task(self.session.close())
+    Adding, removing and picking are all O(1). Removal moves the last element into the removed slot,
+    so iteration order is only insertion order until the first removal."""
+
+    def __init__(self, iterable=()):
+        self._list = []
+        self._pos = {}
+        self.version = 0  # incremented on every change, so derived structures can tell they are stale
+        for i in iterable:
+            self.add(i)
+
+    def add(self, item):
+        if item not in self._pos:
+            self._pos[item] = len(self._list)
+            self._list.append(item)
+            self.version += 1
+
+    def discard(self, item):
+        i = self._pos.pop(item, None)
+        if i is None:
+            return
+        self.version += 1
+        last = self._list.pop()
+        if i < len(self._list):
+            self._list[i] = last
+            self._pos[last] = i
+
+    def __contains__(self, item):
+        return item in self._pos
+
+    def __len__(self):
+        return len(self._list)
+
+    def __iter__(self):
+        return iter(self._list)
+
+    def __getitem__(self, index):
+        return self._list[index]
+
+
+class LRU(OrderedDict):
+    """Dict that keeps at most maxsize items, evicting the least recently used."""
+
+    def __init__(self, maxsize: int=128):
+        super(LRU, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super(LRU, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super(LRU, self).__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
 
 
 def cooldown_reset_if(predicate):